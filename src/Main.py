@@ -1,5 +1,9 @@
-import numpy as np
 import os
+# Threading of MKL-enabled builds of NumPy and TensorFlow; it has to be set before they are imported
+os.environ.setdefault("OMP_NUM_THREADS", str(os.cpu_count()))
+os.environ.setdefault("KMP_BLOCKTIME", "0")
+os.environ.setdefault("TF_ENABLE_MKL_NATIVE_FORMAT", "1")
+import numpy as np
 import sys
 import pandas as pd
 import tensorflow as tf
@@ -83,6 +87,7 @@ def build_and_train_units():
                                n_reconstructed_examples_per_class_to_plot=n_reconstructed_examples_per_class_to_plot,
                                cache_dir=cache_dir,
                                tf_log_dir=tf_log_dir)
+    sort_unit_results(cache_dir)
 
 ############################################################################################
 ##
@@ -150,9 +155,9 @@ def build_pretrained_stack(name, force_rename=False, ordinary_stack = False,
                                          pretrained_weight_initialization=pretrained_weight_initialization,
                                          restore_stack_model=restore_stack_model)
     for hidden_layer in range(stack_builder.n_hidden_layers):
-        train_file_path = os.path.join(cache_dir, "train_codings_hiddenlayer{}of{}.csv".format(hidden_layer+1, stack_builder.n_hidden_layers))
-        valid_file_path = os.path.join(cache_dir, "valid_codings_hiddenlayer{}of{}.csv".format(hidden_layer+1, stack_builder.n_hidden_layers))
-        test_file_path = os.path.join(cache_dir, "test_codings_hiddenlayer{}of{}.csv".format(hidden_layer+1, stack_builder.n_hidden_layers))
+        train_file_path = os.path.join(cache_dir, "train_codings_hiddenlayer{}of{}.parquet".format(hidden_layer+1, stack_builder.n_hidden_layers))
+        valid_file_path = os.path.join(cache_dir, "valid_codings_hiddenlayer{}of{}.parquet".format(hidden_layer+1, stack_builder.n_hidden_layers))
+        test_file_path = os.path.join(cache_dir, "test_codings_hiddenlayer{}of{}.parquet".format(hidden_layer+1, stack_builder.n_hidden_layers))
         stack = stack_builder.get_stack()
         stack.get_codings(stack_builder.stack_model_path, X_train_preprocessed, file_path=train_file_path)
         stack.get_codings(stack_builder.stack_model_path, X_valid_preprocessed, file_path=valid_file_path)
@@ -284,18 +289,18 @@ def gradient_boosting_fit_and_classify(X_train, X_test, y_train, y_test):
 
 def load_train_test_codings(stack_dir, train_codings_csv, valid_codings_csv, test_codings_csv):
     train_file = os.path.join(root_dir, stack_dir, train_codings_csv)
-    df = pd.DataFrame.from_csv(train_file, index_col = 0)
+    df = pd.read_parquet(train_file, engine="pyarrow")
     X_train_codings_1 = pd.DataFrame.as_matrix(df)
     assert(X_train_codings_1.shape[0] == X_train.shape[0]), "Invalid X_train_codings_1"
 
     valid_file = os.path.join(root_dir, stack_dir, valid_codings_csv)
-    df = pd.DataFrame.from_csv(valid_file, index_col = 0)
+    df = pd.read_parquet(valid_file, engine="pyarrow")
     X_train_codings_2 = pd.DataFrame.as_matrix(df)
     assert(X_train_codings_2.shape[0] == X_valid.shape[0]), "Invalid X_train_codings_2"
     X_train_codings = np.vstack((X_train_codings_1, X_train_codings_2))
 
     test_file = os.path.join(root_dir, stack_dir, test_codings_csv)
-    df = pd.DataFrame.from_csv(test_file, index_col = 0)
+    df = pd.read_parquet(test_file, engine="pyarrow")
     X_test_codings = pd.DataFrame.as_matrix(df)
     assert(X_test_codings.shape[0] == X_test.shape[0]), "Invalid X_test_codings"
     return X_train_codings, X_test_codings
@@ -306,9 +311,9 @@ if __name__ == "__main__":
         autoencoder_stack_classifier()
     else:
         stack_dir = "stack_250_250_dropout_elu"
-        train_codings_csv = "train_codings_hiddenlayer2of2.csv"
-        valid_codings_csv = "valid_codings_hiddenlayer2of2.csv"
-        test_codings_csv = "test_codings_hiddenlayer2of2.csv"
+        train_codings_csv = "train_codings_hiddenlayer2of2.parquet"
+        valid_codings_csv = "valid_codings_hiddenlayer2of2.parquet"
+        test_codings_csv = "test_codings_hiddenlayer2of2.parquet"
         X_train_codings, X_test_codings = load_train_test_codings(stack_dir, train_codings_csv, valid_codings_csv, test_codings_csv)
         y_train_codings = np.zeros((y_train.shape[0]+y_valid.shape[0],))
         y_train_codings[:y_train.shape[0]] = y_train
@@ -8,11 +8,40 @@ import matplotlib.pyplot as plt
 import pandas as pd
 import numbers
 from sklearn.preprocessing import MinMaxScaler
+from sklearn.base import clone
+from concurrent.futures import ThreadPoolExecutor
+import threading
 
 from Visual import *
 from Utils import *
 
-class UnitAutoencoder:
+# The models are built as graphs run by sessions; make sure no op is ever dispatched eagerly
+tf.compat.v1.disable_eager_execution()
+
+class _SessionOwner:
+    """
+    Session lifecycle shared by the models: a model owning self.graph, self.session_config and self._sess runs all
+    its evaluations in a single cached session
+    """
+    def _get_session(self):
+        """
+        Return the session of the model; it is created on first use, then reused by all subsequent calls until close().
+        Its variables are not initialized here: the fit and save methods initialize them, the others restore them from
+        a model file
+        """
+        if self._sess is None:
+            self._sess = tf.Session(graph=self.graph, config=self.session_config)
+        return self._sess
+
+    def close(self):
+        """
+        Close the session of the model
+        """
+        if self._sess is not None:
+            self._sess.close()
+            self._sess = None
+
+class UnitAutoencoder(_SessionOwner):
     """
     An autoencoder class that can be used to learn features of the inputs by learning to reconstruct them.
     Two types of autoencoders currently supported: ordinary and denoising autoencoders.
@@ -31,7 +60,10 @@ class UnitAutoencoder:
                  regularizer = tf.contrib.layers.l2_regularizer(0.01),
                  initializer = tf.contrib.layers.variance_scaling_initializer(), # He initialization
                  optimizer = tf.train.AdamOptimizer(0.001),
-                 tf_log_dir = "../tf_logs"):
+                 tf_log_dir = "../tf_logs",
+                 session_config = None,
+                 params_dir = None,
+                 enable_amp = False):
         """
         Ctor
         
@@ -50,6 +82,12 @@ class UnitAutoencoder:
         - regularizer: kernel regularizers for the hidden and output layers
         - optimizer: optimizer used for training
         - tf_log_dir: directory to save logging information for Tensorboard
+        - session_config: tf.ConfigProto of the session running the model; default_session_config() if None
+        - params_dir: directory where the trained params are stored and memory-mapped from (see NpyParams);
+          kept in memory if None
+        - enable_amp: train with automatic mixed precision (float16 compute, float32 master weights); only
+          pays off on GPUs with Tensor Cores and layer sizes that are multiples of 8. Note that TF1 then turns on
+          the auto_mixed_precision graph rewrite for every session created afterwards in the process, not only this model's
 
         Return: None
         """
@@ -62,6 +100,7 @@ class UnitAutoencoder:
         self.hidden_activation = hidden_activation
         self.output_activation = output_activation
         self.regularizer = regularizer
+        self.enable_amp = enable_amp
         self.initializer = initializer
         self.n_observable_hidden_neurons = 0
         if (n_observable_hidden_neurons > 0):
@@ -72,88 +111,181 @@ class UnitAutoencoder:
                 self.n_observable_hidden_neurons = int(n_observable_hidden_neurons * self.n_neurons)
             else:
                 raise ValueError("Invalid type")
+        self.session_config = session_config if session_config is not None else default_session_config()
         self.graph = tf.Graph()
 
         with self.graph.as_default():
-            self.X = tf.placeholder(tf.float32, shape=[None, n_inputs], name="X")
+            # Training batches are drawn from an in-graph input pipeline; X can still be fed directly for evaluation
+            self.X_train_full = tf.placeholder(tf.float32, shape=[None, n_inputs], name="X_train_full")
+            self.batch_size = tf.placeholder(tf.int64, shape=(), name="batch_size")
+            self.shuffle_seed = tf.placeholder(tf.int64, shape=(), name="shuffle_seed")
+            self.train_iterator = _make_train_iterator(self.X_train_full, self.batch_size, self.shuffle_seed)
+            self.X = tf.placeholder_with_default(self.train_iterator.get_next(), shape=[None, n_inputs], name="X")
             self.training = tf.placeholder_with_default(False, shape=(), name='training')
             if (self.noise_stddev is not None):
-                X_noisy = tf.cond(self.training,
-                                  lambda: self.X + tf.random_normal(tf.shape(self.X), stddev = self.noise_stddev),
-                                  lambda: self.X)
+                # Branchless: the noise is scaled by 0 outside of training instead of switching subgraphs with tf.cond
+                noise_mask = tf.cast(self.training, self.X.dtype)
+                X_noisy = self.X + noise_mask * tf.random_normal(tf.shape(self.X), stddev = self.noise_stddev, dtype = self.X.dtype)
             elif (self.input_dropout_rate is not None):
                 X_noisy = tf.layers.dropout(self.X, self.input_dropout_rate, training=self.training)
             else:
                 X_noisy = self.X
-            dense_hidden = tf.layers.dense(X_noisy, n_neurons, activation=hidden_activation, kernel_regularizer = regularizer, name="{}_hidden".format(self.name))
+            # Dense layers go through _dense so that Grappler's remapper can fuse them;
+            # the variable names are the same as the ones tf.layers.dense would create
+            with tf.variable_scope("{}_hidden".format(self.name)):
+                hidden_weights = tf.get_variable("kernel", shape=[n_inputs, n_neurons], regularizer=regularizer)
+                hidden_biases = tf.get_variable("bias", shape=[n_neurons], initializer=tf.zeros_initializer())
+                dense_hidden = _dense(X_noisy, hidden_weights, hidden_biases, hidden_activation)
+            self._hidden_params = (hidden_weights, hidden_biases)
+            # Hidden outputs evaluated in lower precision dtypes, built on first use (see _vars_to_eval)
+            self._low_precision_hidden = {}
             if self.hidden_dropout_rate is None:
                 self.hidden = dense_hidden
             else:
                 self.hidden = tf.layers.dropout(dense_hidden, self.hidden_dropout_rate, training=self.training)
-            self.outputs = tf.layers.dense(self.hidden, n_inputs, activation=output_activation, kernel_regularizer = regularizer, name="{}_outputs".format(self.name))
+            with tf.variable_scope("{}_outputs".format(self.name)):
+                output_weights = tf.get_variable("kernel", shape=[n_neurons, n_inputs], regularizer=regularizer)
+                output_biases = tf.get_variable("bias", shape=[n_inputs], initializer=tf.zeros_initializer())
+                self.outputs = _dense(self.hidden, output_weights, output_biases, output_activation)
             self.reg_losses = tf.get_collection(tf.GraphKeys.REGULARIZATION_LOSSES)
             self.reconstruction_loss = tf.reduce_mean(tf.square(self.outputs - self.X))
             self.loss = tf.add_n([self.reconstruction_loss] + self.reg_losses)
+            # Tensors that can be evaluated by name (see eval and restore_and_eval)
+            self.varmap = {"loss": self.loss,
+                           "reconstruction_loss": self.reconstruction_loss,
+                           "hidden_outputs": self.hidden,
+                           "outputs": self.outputs}
+            if self.enable_amp:
+                # Grappler inserts the float16 casts around the matmuls and the optimizer applies dynamic loss scaling
+                optimizer = tf.train.experimental.enable_mixed_precision_graph_rewrite(optimizer)
             self.training_op = optimizer.minimize(self.loss)
+            # The validation set is uploaded once per fit into a variable kept out of the checkpoints, and the
+            # validation loss is computed from it without any feed (no noise nor dropout at evaluation).
+            # It depends on the training op, so a checkpoint step trains and validates the new weights in one run.
+            self.X_valid_full = tf.placeholder(tf.float32, shape=[None, n_inputs], name="X_valid_full")
+            self.X_valid_resident = tf.Variable(self.X_valid_full, trainable=False, collections=[],
+                                                validate_shape=False, name="X_valid_resident")
+            with tf.name_scope("valid"), tf.control_dependencies([self.training_op]):
+                # Fresh reads created under the control dependency: the cached /read snapshots of the variables
+                # are not ordered after the update
+                hidden_weights_after_step, hidden_biases_after_step, output_weights_after_step, output_biases_after_step = [
+                    var.read_value() for var in (hidden_weights, hidden_biases, output_weights, output_biases)]
+                X_valid = tf.reshape(self.X_valid_resident, [-1, n_inputs])
+                valid_hidden = _dense(X_valid, hidden_weights_after_step, hidden_biases_after_step, hidden_activation)
+                valid_outputs = _dense(valid_hidden, output_weights_after_step, output_biases_after_step, output_activation)
+                # A regularizer may return None (e.g. a zero scale), like the ones tf.get_variable ignores
+                valid_reg_losses = [reg_loss for reg_loss in (regularizer(hidden_weights_after_step), regularizer(output_weights_after_step))
+                                    if reg_loss is not None] if regularizer else []
+                self.valid_loss_after_step = tf.add_n([tf.reduce_mean(tf.square(valid_outputs - X_valid))] + valid_reg_losses)
             self.init = tf.global_variables_initializer()
-            self.saver = tf.train.Saver()
+            # Each fit overwrites its own model_path; nothing is tracked for deletion, so that a unit reused
+            # across folds keeps the models of the previous folds
+            self.saver = tf.train.Saver(max_to_keep=None, save_relative_paths=True)
 
-            loss_str = "Reconstruction_and_regularizer loss" if regularizer else "Reconstruction_loss"
-            self.loss_summary = tf.summary.scalar(loss_str, self.loss)
+            # Also the tag of the summary, used as is for the validation loss
+            self.loss_summary_tag = "Reconstruction_and_regularizer_loss" if regularizer else "Reconstruction_loss"
+            self.loss_summary = tf.summary.scalar(self.loss_summary_tag, self.loss)
+            summaries = [self.loss_summary]
             # Ops to observe neurons
             if (self.n_observable_hidden_neurons > 0):
-                trainable_vars = dict([(var.name, var) for var in tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES)])
-                hidden_weights = trainable_vars["{}_hidden/kernel:0".format(self.name)]
                 assert(hidden_weights.shape == (n_inputs, n_neurons)), "Invalid hidden weight shape"
-                hidden_biases = trainable_vars["{}_hidden/bias:0".format(self.name)]
                 if self.n_observable_hidden_neurons == self.n_neurons:
                     # Optimization for corner case to avoid permutation
                     neuron_indices = np.arange(self.n_neurons)
                 else:
                     neuron_indices = list(np.random.permutation(np.arange(n_neurons))[:self.n_observable_hidden_neurons])
-                for neuron_idx in neuron_indices:
-                    self._variable_summaries(hidden_weights[:, neuron_idx], "weights_hidden_neuron_{}".format(neuron_idx))
-                    self._variable_summaries(hidden_biases[neuron_idx], "bias_hidden_neuron_{}".format(neuron_idx))
-                    self._variable_summaries(self.hidden[:, neuron_idx], "activation_hidden_neuron_{}".format(neuron_idx))
+                # Gather the observable neurons once and summarize them together rather than neuron by neuron
+                summaries += self._variable_summaries(tf.gather(hidden_weights, neuron_indices, axis=1), "weights_hidden_observable")
+                summaries += [tf.summary.histogram("bias_hidden_observable", tf.gather(hidden_biases, neuron_indices))]
+                summaries += self._variable_summaries(tf.gather(self.hidden, neuron_indices, axis=1), "activation_hidden_observable")
             
-            self.summary = tf.summary.merge_all()
-            tf_log_dir = "{}/{}_run-{}".format(tf_log_dir, self.name, timestr())
-            self.train_file_writer = tf.summary.FileWriter(os.path.join(tf_log_dir, "train"), self.graph)
-            self.valid_file_writer = tf.summary.FileWriter(os.path.join(tf_log_dir, "valid"), self.graph)
+            self.summary = tf.summary.merge(summaries)
+
+        # Tensorboard writers and stop file of the current run, opened by open_file_writers
+        self.tf_log_dir = tf_log_dir
+        self.train_file_writer = None
+        self.valid_file_writer = None
+        self.stop_file_path = None
             
         # Dictionary of trainable parameters: key = variable name, values are their values (after training or
-        # restored from a model)
+        # restored from a model); memory-mapped from params_dir if set
         self.params = None
+        self.params_dir = params_dir
 
         # The trainable params with initial values (before traininig or restoration)
         self.initial_params = None
 
-        # Stop file: if this file exists, the training will stop
-        self.stop_file_path = os.path.join(tf_log_dir, "stop")
+        # Session shared by training, restoration and evaluation (see _get_session)
+        self._sess = None
+        # Model file whose params the session currently holds, if any (see _restore)
+        self._loaded_model_path = None
         
+    def open_file_writers(self, run_name = None):
+        """
+        Start a new run: the next fit logs to new Tensorboard writers, and watches the stop file of the run
+        (if this file exists, the training will stop). A fit opens a run named after the unit if none is open,
+        and closes its run when done.
+
+        Arguments:
+        - run_name: name of the run; the name of the unit if None
+        """
+        self._close_file_writers()
+        run_dir = "{}/{}_run-{}".format(self.tf_log_dir, self.name if run_name is None else run_name, timestr())
+        self.train_file_writer = tf.summary.FileWriter(os.path.join(run_dir, "train"), self.graph)
+        self.valid_file_writer = tf.summary.FileWriter(os.path.join(run_dir, "valid"), self.graph)
+        self.stop_file_path = os.path.join(run_dir, "stop")
+
+    def _close_file_writers(self):
+        if self.train_file_writer is not None:
+            self.train_file_writer.close()
+            self.valid_file_writer.close()
+            self.train_file_writer = None
+            self.valid_file_writer = None
+
     def _variable_summaries(self, var, tag):
-      """Attach summaries to a Tensor (for TensorBoard visualization)."""
+      """Attach summaries of the neurons (columns) of a Tensor: histograms over the neurons of their
+      mean, stddev, max and min, and of all the values (for TensorBoard visualization).
+      Return the list of summary ops."""
       with tf.name_scope(tag):
-        mean = tf.reduce_mean(var)
-        tf.summary.scalar('mean', mean)
+        mean = tf.reduce_mean(var, axis=0)
         with tf.name_scope('stddev'):
-          stddev = tf.sqrt(tf.reduce_mean(tf.square(var - mean)))
-        tf.summary.scalar('stddev', stddev)
-        tf.summary.scalar('max', tf.reduce_max(var))
-        tf.summary.scalar('min', tf.reduce_min(var))
-        tf.summary.histogram('histogram', var)    
+          stddev = tf.sqrt(tf.reduce_mean(tf.square(var - mean), axis=0))
+        return [tf.summary.histogram('mean', mean),
+                tf.summary.histogram('stddev', stddev),
+                tf.summary.histogram('max', tf.reduce_max(var, axis=0)),
+                tf.summary.histogram('min', tf.reduce_min(var, axis=0)),
+                tf.summary.histogram('histogram', var)]
+
+    def close(self):
+        """
+        Close the session of the model; the next evaluation restores the model file again
+        """
+        super().close()
+        self._loaded_model_path = None
+
+    def _restore(self, sess, model_path):
+        """
+        Restore the params of a model file into the session and self.params, unless the session already holds them
+        """
+        if model_path != self._loaded_model_path:
+            self.saver.restore(sess, model_path)
+            self.params = self._fetch_params(sess)
+            self._loaded_model_path = model_path
 
     def save_untrained_model(self, model_path, seed = 42):
         """
         Simply initialize the model's params and save to file; used for experiment purposes.
         """
-        with tf.Session(graph=self.graph) as sess:
+        sess = self._get_session()
+        with self.graph.as_default(), sess.as_default():
             tf.set_random_seed(seed)
             self.init.run()
-            self.initial_params = dict([(var.name, var.eval()) for var in tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES)])
+            self._loaded_model_path = None
+            self.initial_params = _trainable_params(sess, self.graph)
             self.saver.save(sess, model_path)
         
-    def fit(self, X_train, X_valid, n_epochs, model_path, save_best_only = True, batch_size = 256, checkpoint_steps = 100, seed = 42, tfdebug = False):
+    def fit(self, X_train, X_valid, n_epochs, model_path, save_best_only = True, batch_size = 256, checkpoint_steps = 100, seed = 42, tfdebug = False,
+            min_train_improvement = None):
         """
         Train the unit autoencoder against a training set
 
@@ -163,57 +295,97 @@ class UnitAutoencoder:
         - n_epochs: number of epochs to train
         - model_path: absolute path to the model file to be saved
         - save_best_only: only save the model when the performance improves (on the validation set)
-        - batch_size: batch size
+        - batch_size: batch size; every step uses exactly batch_size samples, the rows left over at the end of an epoch are skipped
         - checkpoint_steps: number of steps to record checkpoints and log information
         - seed: random seed for tf
         - tf_debug: turn on to debug in TensorFlow
+        - min_train_improvement: only validate at a checkpoint if the moving average of the training loss has improved
+          by this relative amount since the last validation (as of the previous checkpoint); validate at every checkpoint if None
         """
         assert(self.X.shape[1] == X_train.shape[1]), "Invalid input shape"
-        with tf.Session(graph=self.graph) as sess:
+        # Convert once here rather than letting every feed convert its own copy to float32
+        X_train = np.ascontiguousarray(X_train, dtype=np.float32)
+        X_valid = np.ascontiguousarray(X_valid, dtype=np.float32)
+        if self.train_file_writer is None:
+            self.open_file_writers()
+        sess = self._get_session()
+        with self.graph.as_default(), sess.as_default():
             if tfdebug:
                 sess = tf_debug.LocalCLIDebugWrapperSession(sess)
             if batch_size is None:
                 batch_size = len(X_train)
             tf.set_random_seed(seed)
             self.init.run()
-            self.initial_params = dict([(var.name, var.eval()) for var in tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES)])
+            self._loaded_model_path = None
+            self.initial_params = _trainable_params(sess, self.graph)
             best_loss_on_valid_set = 100000
             model_step = -1
             stop = False
-            for epoch in tqdm(range(n_epochs)):
-                X_train_indices = np.random.permutation(len(X_train))
-                n_batches = len(X_train) // batch_size
-                start_idx = 0
-                for batch_idx in range(n_batches):
-                    indices = X_train_indices[start_idx : start_idx + batch_size]
-                    X_batch = X_train[indices]
-                    sess.run(self.training_op, feed_dict={self.X: X_batch, self.training: True})                    
-                    step = epoch * n_batches + batch_idx
-                    if step % checkpoint_steps == 0:
-                        train_summary = sess.run(self.summary, feed_dict={self.X: X_batch})
-                        self.train_file_writer.add_summary(train_summary, step)
-                        loss_on_valid_set, loss_summary_on_valid_set = sess.run([self.loss, self.loss_summary], feed_dict={self.X: X_valid})
-                        self.valid_file_writer.add_summary(loss_summary_on_valid_set, step)
-                        model_to_save = (not save_best_only) or (loss_on_valid_set < best_loss_on_valid_set)
-                        if loss_on_valid_set < best_loss_on_valid_set:
-                            best_loss_on_valid_set = loss_on_valid_set
-                        if model_to_save:
-                            self.saver.save(sess, model_path)
-                            model_step = step
-                        # Check if stop signal exists
-                        if os.path.exists(self.stop_file_path):
-                            stop = True
-                    start_idx += batch_size
-                if stop:
-                    print("Stopping command detected: {}".format(self.stop_file_path))
-                    break
-            self.params = dict([(var.name, var.eval()) for var in tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES)])
-            self.train_file_writer.close()
-            self.valid_file_writer.close()
+            n_batches = len(X_train) // batch_size
+            assert(n_batches > 0), "Batch size larger than the training set"
+            sess.run(self.train_iterator.initializer, feed_dict={self.X_train_full: X_train,
+                                                                 self.batch_size: batch_size,
+                                                                 self.shuffle_seed: seed})
+            sess.run(self.X_valid_resident.initializer, feed_dict={self.X_valid_full: X_valid})
+            # The training summary and loss come from the forward pass of the training step itself
+            checkpoint_fetches = [self.summary, self.loss, self.valid_loss_after_step]
+            gated_checkpoint_fetches = [self.training_op, self.summary, self.loss]
+            valid_gate = _ValidationGate(min_train_improvement)
+            train_feed_dict = {self.training: True}
+            # Plain training steps go through a callable: the fetches and feeds are pruned and validated once
+            train_step = sess.make_callable(self.training_op, feed_list=[self.training])
+            stop_watcher = StopFileWatcher(self.stop_file_path).start()
+            try:
+                for epoch in tqdm(range(n_epochs)):
+                    for batch_idx in range(n_batches):
+                        step = epoch * n_batches + batch_idx
+                        if step % checkpoint_steps != 0:
+                            train_step(True)
+                        else:
+                            # The validation loss is fused with the training step, so the gate is checked before the run
+                            to_validate = valid_gate.should_validate()
+                            if to_validate:
+                                train_summary, train_loss, loss_on_valid_set = sess.run(checkpoint_fetches, feed_dict=train_feed_dict)
+                            else:
+                                _, train_summary, train_loss = sess.run(gated_checkpoint_fetches, feed_dict=train_feed_dict)
+                            valid_gate.update(train_loss)
+                            self.train_file_writer.add_summary(train_summary, step)
+                            if to_validate:
+                                loss_summary_on_valid_set = tf.Summary(value=[tf.Summary.Value(tag=self.loss_summary_tag,
+                                                                                               simple_value=loss_on_valid_set)])
+                                self.valid_file_writer.add_summary(loss_summary_on_valid_set, step)
+                                model_to_save = (not save_best_only) or (loss_on_valid_set < best_loss_on_valid_set)
+                                if loss_on_valid_set < best_loss_on_valid_set:
+                                    best_loss_on_valid_set = loss_on_valid_set
+                                if model_to_save:
+                                    # The graph does not change during training: only the first save writes the meta graph
+                                    first_save = model_step < 0
+                                    self.saver.save(sess, model_path, write_meta_graph=first_save, write_state=first_save)
+                                    model_step = step
+                            # Check if stop signal exists
+                            if stop_watcher.is_set():
+                                stop = True
+                    if stop:
+                        print("Stopping command detected: {} or SIGUSR1".format(self.stop_file_path))
+                        break
+            finally:
+                stop_watcher.close()
+            self.params = self._fetch_params(sess)
+            # The session still holds the saved model only if no step ran after the last save
+            if model_step == step:
+                self._loaded_model_path = model_path
+            self._close_file_writers()
             assert(model_step >= 0), "Invalid model step"
             all_steps = n_epochs * n_batches
             return model_step, all_steps
         
+    def _fetch_params(self, sess):
+        """
+        Fetch the trained params from the session, storing them in self.params_dir if set
+        """
+        params = _trainable_params(sess, self.graph)
+        return params if self.params_dir is None else NpyParams.save(params, self.params_dir)
+
     def hidden_weights(self, file_path = None):
         """
         Retrieve the weights of hidden neurons. Optionally allow them to be saved to file.
@@ -221,10 +393,7 @@ class UnitAutoencoder:
         assert(self.params is not None), "Invalid self.params"
         w = self.params["{}_hidden/kernel:0".format(self.name)]
         if file_path is not None:
-            W = np.array(w)
-            columns = ["neuron_{}".format(idx) for idx in range(W.shape[1])]
-            df = pd.DataFrame(data=W, columns=columns)
-            df.to_csv(file_path)
+            _save_neurons_csv(w, file_path)
         return w
 
     def hidden_biases(self, file_path = None):
@@ -234,10 +403,7 @@ class UnitAutoencoder:
         assert(self.params is not None), "Invalid self.params"
         w = self.params["{}_hidden/bias:0".format(self.name)]
         if file_path is not None:
-            W = np.array(w)
-            columns = ["neuron_{}".format(idx) for idx in range(W.shape[1])]
-            df = pd.DataFrame(data=W, columns=columns)
-            df.to_csv(file_path)
+            _save_neurons_csv(w.reshape(1, -1), file_path)
         return w
     
     def output_weights(self):
@@ -245,14 +411,14 @@ class UnitAutoencoder:
         Retrieve the weights of output neurons
         """
         assert(self.params is not None), "Invalid self.params"
-        return self.params["{}_output/kernel:0".format(self.name)]
+        return self.params["{}_outputs/kernel:0".format(self.name)]
 
     def output_biases(self):
         """
         Retrieve the biases of output neurons
         """
         assert(self.params is not None), "Invalid self.params"
-        return self.params["{}_output/bias:0".format(self.name)]
+        return self.params["{}_outputs/bias:0".format(self.name)]
     
     def restore(self, model_path):
         """
@@ -268,81 +434,76 @@ class UnitAutoencoder:
         """
         if self.params is not None:
             print(">> Warning: self.params not empty and will be replaced")
-        with tf.Session(graph=self.graph) as sess:
-            self.saver.restore(sess, model_path)
-            self.params = dict([(var.name, var.eval()) for var in tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES)])
+        sess = self._get_session()
+        with self.graph.as_default(), sess.as_default():
+            self._restore(sess, model_path)
 
-    def eval(self, X, varlist):
+    def _vars_to_eval(self, varlist, eval_dtype = None):
+        """
+        Map variable names to tensors; with eval_dtype, "hidden_outputs" is computed by an encoder whose input,
+        weights and biases are cast to eval_dtype (the result is cast back to float32)
+        """
+        if eval_dtype is not None and "hidden_outputs" in varlist and eval_dtype not in self._low_precision_hidden:
+            hidden_weights, hidden_biases = self._hidden_params
+            with self.graph.as_default(), tf.name_scope("{}_hidden_{}".format(self.name, eval_dtype.name)):
+                hidden = _dense(tf.cast(self.X, eval_dtype), tf.cast(hidden_weights, eval_dtype), tf.cast(hidden_biases, eval_dtype),
+                                self.hidden_activation)
+                self._low_precision_hidden[eval_dtype] = tf.cast(hidden, tf.float32)
+        return [self._low_precision_hidden[eval_dtype] if var == "hidden_outputs" and eval_dtype is not None else self.varmap[var]
+                for var in varlist]
+
+    def eval(self, X, varlist, eval_batch_size = 10000, eval_dtype = None):
         """
         Evaluate certain tensors for a vector of inputs
         
         Params:
         - X: input tensor of shape (n_examples, n_features)
         - varlist: list of any of the following variables "loss", "reconstruction_loss", "hidden_outputs", "outputs"
+        - eval_batch_size: maximum number of examples fed per run
+        - eval_dtype: if set (e.g. tf.bfloat16 or tf.float16), compute "hidden_outputs" in this precision;
+          only worth it when the hidden outputs are evaluated alone, as the other variables stay in float32
 
         Return:
         - list of values of the variables after evaluation
         """
         assert(self.params), "Invalid self.params"
-        with tf.Session(graph=self.graph) as sess:
-            varmap = {"loss": self.loss,
-                      "reconstruction_loss": self.reconstruction_loss,
-                      "hidden_outputs": self.hidden,
-                      "outputs": self.outputs}
-            vars_to_eval = []
-            for var in varlist:
-                # The order of var in the list needs to be kept, thus this for-loop
-                if var == "loss":
-                    vars_to_eval += [self.loss]
-                elif var == "reconstruction_loss":
-                    vars_to_eval += [self.reconstruction_loss]
-                elif var == "hidden_outputs":
-                    vars_to_eval += [self.hidden]
-                elif var == "outputs":
-                    vars_to_eval += [self.outputs]
-                else:
-                    raise ValueError("Unrecognized variable {} to evaluate".format(var))
-            return sess.run(vars_to_eval, feed_dict={self.X: X})
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        sess = self._get_session()
+        with self.graph.as_default(), sess.as_default():
+            vars_to_eval = self._vars_to_eval(varlist, eval_dtype)
+            return _run_in_batches(sess, vars_to_eval, {self.X: X}, eval_batch_size)
         
-    def restore_and_eval(self, X, model_path, varlist, tfdebug = False):
+    def restore_and_eval(self, X, model_path, varlist, tfdebug = False, eval_batch_size = 10000, eval_dtype = None):
         """
         Restore model's params and evaluate variables
 
         Arguments:
+        - X: the input of shape (n_examples, n_features), or a list of such inputs evaluated after a single restoration
         - model_path: full path to the model file
         - varlist: list of variables to evaluate. Valid values: "loss", "reconstruction_loss", "hidden_outputs", "outputs"
+        - eval_batch_size: maximum number of examples fed per run
+        - eval_dtype: if set, compute "hidden_outputs" in this precision (see eval)
 
-        Return: a list of evaluated variables
+        Return: a list of evaluated variables; for a list of inputs, the variables of the first input, then those
+        of the second input, etc.
         """
         assert(self.graph), "Invalid graph"
-        with tf.Session(graph=self.graph) as sess:
-            self.saver.restore(sess, model_path)
-            self.params = dict([(var.name, var.eval()) for var in tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES)])
+        Xs = X if isinstance(X, list) else [X]
+        sess = self._get_session()
+        with self.graph.as_default(), sess.as_default():
+            self._restore(sess, model_path)
             if tfdebug:
                 sess = tf_debug.LocalCLIDebugWrapperSession(sess)
-            varmap = {"loss": self.loss,
-                      "reconstruction_loss": self.reconstruction_loss,
-                      "hidden_outputs": self.hidden,
-                      "outputs": self.outputs}
-            vars_to_eval = []
-            for var in varlist:
-                # The order of var in the list needs to be kept, thus this for-loop
-                if var == "loss":
-                    vars_to_eval += [self.loss]
-                elif var == "reconstruction_loss":
-                    vars_to_eval += [self.reconstruction_loss]
-                elif var == "hidden_outputs":
-                    vars_to_eval += [self.hidden]
-                elif var == "outputs":
-                    vars_to_eval += [self.outputs]
-            return sess.run(vars_to_eval, feed_dict={self.X: X})
+            vars_to_eval = self._vars_to_eval(varlist, eval_dtype)
+            return [value for X in Xs
+                    for value in _run_in_batches(sess, vars_to_eval, {self.X: np.ascontiguousarray(X, dtype=np.float32)}, eval_batch_size)]
 
 #####################################################################################################################
 ##
 ## StackAutoencoders class
 ##
 #####################################################################################################################
-class StackedAutoencoders:
+class StackedAutoencoders(_SessionOwner):
     """
     The StackedAutoencoders class provides services to stack the encoders of pretrained auto-encoders, and optionally
     also stack a softmax output layer for classification.
@@ -350,7 +511,9 @@ class StackedAutoencoders:
     def __init__(self,
                  name,
                  cache_dir = "../cache",
-                 tf_log_dir = "../tf_logs"):
+                 tf_log_dir = "../tf_logs",
+                 session_config = None,
+                 enable_amp = False):
         """
         Ctor
         Most of the properties are to be initilized during the construction of the stack
@@ -359,33 +522,68 @@ class StackedAutoencoders:
         - name: name of the stack
         - cache_dir: cache directory to store the stack model
         - tf_log_dir: directory to store logging information for Tensorboard
+        - session_config: tf.ConfigProto of the session running the model; default_session_config() if None
+        - enable_amp: train with automatic mixed precision (float16 compute, float32 master weights); only
+          pays off on GPUs with Tensor Cores. Note that TF1 then turns on the auto_mixed_precision graph rewrite
+          for every session created afterwards in the process, not only this stack's
         """
         self.name = name
         self.stacked_units = []
+        self.session_config = session_config if session_config is not None else default_session_config()
+        self.enable_amp = enable_amp
         self.graph = None
         self.initial_params = None
         self.params = None
         self.cache_dir = cache_dir
         self.tf_log_dir = tf_log_dir
 
+        self.X_train_full = None
+        self.y_train_full = None
+        self.batch_size = None
+        self.shuffle_seed = None
+        self.train_iterator = None
         self.X = None
+        self.y = None
         self.training = None
         self.loss = None
         self.hidden = []  # outputs of all hidden layers
         self.outputs = None # the final output layer
         self.encoders = []
         self.decoders = []
+        self.reg_losses = [] # regularization losses of all layers
+        self.entropy_loss = None # loss of the softmax output layer
+        self.reconstruction_loss = None # loss of the reconstruction layer
+        self._layer_fns = [] # functions applying the layers (sharing their variables) to a new input, in stack order
+        self.num_gpus = 1
         self.training_op = None
         self.saver = None
         self.loss_summary = None
         self.summary = None
         self.train_file_writer = None        
         self.stop_file_path = os.path.join(cache_dir, "stop")
+        self.init = None
+        self.init_feed_dict = {} # pretrained values of the variables, fed when running self.init
+        self.varmap = {}
+        self._sess = None
       
+    def _pretrained_variable(self, value, name, trainable = True):
+        """
+        Create a variable holding pretrained values. The values are fed to its initializer through
+        a placeholder (see self.init_feed_dict) instead of being embedded in the graph definition.
+        Frozen values (trainable False) are embedded as a constant instead, which Grappler/XLA can fold
+        into the following ops, and which is neither in the gradients nor in the checkpoints.
+        """
+        if not trainable:
+            return tf.constant(value, dtype=tf.float32, name = name)
+        initial_value = tf.placeholder(tf.float32, shape=value.shape, name="{}_initial_value".format(name))
+        self.init_feed_dict[initial_value] = value
+        return tf.Variable(initial_value, name = name, trainable = trainable)
+
     def _add_hidden_layer(self, input_tensor, unit, layer_name,
                           regularizer,
                           input_dropout_rate,
-                          hidden_dropout_rate):
+                          hidden_dropout_rate,
+                          trainable = True):
         """
         Stack the encoder part of an auto-encoder to the top of the current stack, reusing its pretrained weights and biases.
         
@@ -396,56 +594,56 @@ class StackedAutoencoders:
         - regularizer: regularization applied to the weights; ignored if None
         - input_dropout_rate: the rate of the dropout layer right after the input; ignored if None
         - hidden_dropout_rate: the rate of the dropout layer right after the new layer; ignored if None
+        - trainable: fine-tune the pretrained weights and biases; if False they are graph constants (no gradients nor optimizer slots)
 
         Return: 
         - hidden_drop: the output of the new layer, optionally with dropouts
-        - reg_loss: the regularization loss
+        - reg_loss: the regularization loss; None for a frozen layer
+        - layer_fn: function applying the new layer to another input tensor
         """
         assert(unit.params), "Invalid unit.params"
         with tf.name_scope(layer_name):
-            input_drop = input_tensor if input_dropout_rate is None else tf.layers.dropout(input_tensor, rate=input_dropout_rate, training=self.training)
-            weights = tf.Variable(unit.hidden_weights(), name = "weights")
+            weights = self._pretrained_variable(unit.hidden_weights(), name = "weights", trainable = trainable)
             assert(weights.shape == (unit.n_inputs, unit.n_neurons)), "Wrong assumption about weight's shape"
-            biases = tf.Variable(unit.hidden_biases(), name = "biases")
+            biases = self._pretrained_variable(unit.hidden_biases(), name = "biases", trainable = trainable)
             assert(biases.shape == (unit.n_neurons,)), "Wrong assumption about bias's shape"
-            pre_activations = tf.matmul(input_drop, weights) + biases
-            if unit.hidden_activation is not None:
-                hidden_outputs = unit.hidden_activation(pre_activations, name = "hidden_outputs")
-            else:
-                hidden_outputs = pre_activations
-            hidden_drop = hidden_outputs if hidden_dropout_rate is None else tf.layers.dropout(hidden_outputs, rate=hidden_dropout_rate, training=self.training)
-            reg_loss = regularizer(weights) if regularizer else None
-            return hidden_drop, reg_loss
+            def layer_fn(inputs):
+                input_drop = inputs if input_dropout_rate is None else tf.layers.dropout(inputs, rate=input_dropout_rate, training=self.training)
+                hidden_outputs = _dense(input_drop, weights, biases, unit.hidden_activation)
+                return hidden_outputs if hidden_dropout_rate is None else tf.layers.dropout(hidden_outputs, rate=hidden_dropout_rate, training=self.training)
+            hidden_drop = layer_fn(input_tensor)
+            reg_loss = regularizer(weights) if regularizer and trainable else None
+            return hidden_drop, reg_loss, layer_fn
 
     def _add_output_layer(self, input_tensor, unit, layer_name,
                           regularizer,
                           input_dropout_rate,
-                          output_dropout_rate):
+                          output_dropout_rate,
+                          trainable = True):
         """
         Add an output layer of a pretrained auto-encoder to the stack.
         This functionality plans to used for symmetrical ordinary autoencoder that aims
-        at reconstructing its inputs. Not being used so far.
+        at reconstructing its inputs. Not being used so far. A frozen layer (trainable False) is not regularized.
         """
         assert(unit.params), "Invalid unit.params"
         with tf.name_scope(layer_name):
-            input_drop = input_tensor if input_dropout_rate is None else tf.layers.dropout(input_tensor, rate=input_dropout_rate, training=self.training)
-            weights = tf.Variable(unit.output_weights(), name = "weights")
-            assert(weights.shape == (unit.n_inputs, unit.n_neurons)), "Wrong assumption about weight's shape"
-            biases = tf.Variable(unit.output_biases(), name = "biases")
-            assert(biases.shape == (unit.n_neurons,)), "Wrong assumption about bias's shape"
-            pre_activations = tf.matmul(input_drop, weights) + biases
-            if unit.output_activation is not None:
-                outputs = unit.output_activation(pre_activations, name = "hidden_outputs")
-            else:
-                outputs = pre_activations
-            outputs_drop = outputs if output_dropout_rate is None else tf.layers.dropout(outputs, rate=output_dropout_rate, training=self.training)
-            reg_loss = regularizer(weights) if regularizer else None
-            return outputs_drop, reg_loss
+            weights = self._pretrained_variable(unit.output_weights(), name = "weights", trainable = trainable)
+            assert(weights.shape == (unit.n_neurons, unit.n_inputs)), "Wrong assumption about weight's shape"
+            biases = self._pretrained_variable(unit.output_biases(), name = "biases", trainable = trainable)
+            assert(biases.shape == (unit.n_inputs,)), "Wrong assumption about bias's shape"
+            def layer_fn(inputs):
+                input_drop = inputs if input_dropout_rate is None else tf.layers.dropout(inputs, rate=input_dropout_rate, training=self.training)
+                outputs = _dense(input_drop, weights, biases, unit.output_activation)
+                return outputs if output_dropout_rate is None else tf.layers.dropout(outputs, rate=output_dropout_rate, training=self.training)
+            outputs_drop = layer_fn(input_tensor)
+            reg_loss = regularizer(weights) if regularizer and trainable else None
+            return outputs_drop, reg_loss, layer_fn
         
     def stack_encoder(self, unit, layer_name,
                       regularizer = None,
                       input_dropout_rate = 0,
-                      hidden_dropout_rate = 0):
+                      hidden_dropout_rate = 0,
+                      trainable = True):
         """
         Add the encoder part of an auto-encoder to the stack.
         
@@ -456,6 +654,7 @@ class StackedAutoencoders:
         - regularizer: regularization applied to the weights; ignored if None
         - input_dropout_rate: the rate of the dropout layer right after the input; ignored if None
         - hidden_dropout_rate: the rate of the dropout layer right after the new layer; ignored if None
+        - trainable: fine-tune the pretrained weights of the layer; freeze them as graph constants if False
 
         Return: None
         """
@@ -463,40 +662,52 @@ class StackedAutoencoders:
         with self.graph.as_default():
             intput_tensor = None
             if not self.hidden: # empty hidden layers
-                self.X = tf.placeholder(tf.float32, shape=(None, unit.n_inputs), name="X")
-                self.y = tf.placeholder(tf.int64, shape=(None), name="y")
+                # Training batches are drawn from an in-graph input pipeline; X and y can still be fed directly for evaluation
+                self.X_train_full = tf.placeholder(tf.float32, shape=(None, unit.n_inputs), name="X_train_full")
+                self.y_train_full = tf.placeholder(tf.int64, shape=(None), name="y_train_full")
+                self.batch_size = tf.placeholder(tf.int64, shape=(), name="batch_size")
+                self.shuffle_seed = tf.placeholder(tf.int64, shape=(), name="shuffle_seed")
+                self.train_iterator = _make_train_iterator((self.X_train_full, self.y_train_full), self.batch_size, self.shuffle_seed)
+                X_batch, y_batch = self.train_iterator.get_next()
+                self.X = tf.placeholder_with_default(X_batch, shape=(None, unit.n_inputs), name="X")
+                self.y = tf.placeholder_with_default(y_batch, shape=(None), name="y")
                 self.training = tf.placeholder_with_default(False, shape=(), name="training")
                 input_tensor = self.X
             else:
                 input_tensor = self.hidden[-1]
-            hidden, reg_loss = self._add_hidden_layer(input_tensor, unit, layer_name,
-                                                      regularizer, input_dropout_rate, hidden_dropout_rate)
+            hidden, reg_loss, layer_fn = self._add_hidden_layer(input_tensor, unit, layer_name,
+                                                                regularizer, input_dropout_rate, hidden_dropout_rate,
+                                                                trainable)
             self.hidden += [hidden]
             self.encoders += [hidden]
+            self._layer_fns += [layer_fn]
             self.stacked_units += [unit]
             if reg_loss is not None:
-                self.loss = tf.add_n([self.loss, reg_loss]) if self.loss is not None else reg_loss
+                self.reg_losses += [reg_loss]
 
     def stack_decoder(self, unit, layer_name,
                       is_reconstruction_layer = False,
                       regularizer = None,
                       input_dropout_rate = 0,
-                      output_dropout_rate = 0):
+                      output_dropout_rate = 0,
+                      trainable = True):
         """
         Stack the decoder part of an auto-encoder to the stack. Not being used so far.
+        Its pretrained weights are frozen if trainable is False (see stack_encoder).
         """
         self.graph = tf.Graph() if self.graph is None else self.graph
         with self.graph.as_default():
             assert(self.hidden), "Empty encoder layers"
             input_tensor = self.hidden[-1]
-            outputs, reg_loss = self._add_output_layer(input_tensor, unit, layer_name,
-                                                       regularizer, input_dropout_rate, output_dropout_rate)
+            outputs, reg_loss, layer_fn = self._add_output_layer(input_tensor, unit, layer_name,
+                                                                 regularizer, input_dropout_rate, output_dropout_rate,
+                                                                 trainable)
+            self._layer_fns += [layer_fn]
             if reg_loss is not None:
-                self.loss = tf.add_n([self.loss, reg_loss]) if self.loss is not None else reg_loss
+                self.reg_losses += [reg_loss]
             if is_reconstruction_layer:
                 self.outputs = outputs
-                reconstruction_loss = tf.reduce_mean(tf.square(self.outputs - self.X))
-                self.loss = tf.add_n([self.loss, reconstruction_loss]) if self.loss is not None else reconstruction_loss
+                self.reconstruction_loss = tf.reduce_mean(tf.square(self.outputs - self.X))
             else:
                 self.hidden += [outputs]
                 self.decoders += [outputs]
@@ -529,46 +740,103 @@ class StackedAutoencoders:
                 biases = tf.get_variable(name="biases",
                                          shape=(n_classes, ),
                                          initializer=bias_initializer)
-                self.outputs = tf.matmul(self.hidden[-1], weights) + biases
+                def layer_fn(inputs):
+                    return _dense(inputs, weights, biases)
+                self.outputs = layer_fn(self.hidden[-1])
+                self._layer_fns += [layer_fn]
             with tf.variable_scope("loss"):
                 cross_entropy = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=self.y, logits=self.outputs)
-                entropy_loss = tf.reduce_mean(cross_entropy, name="entropy_loss")
-                self.loss = tf.add_n([self.loss, entropy_loss]) if self.loss is not None else entropy_loss
-                self.loss = tf.add_n([self.loss, kernel_regularizer(weights)]) if kernel_regularizer is not None else self.loss
+                self.entropy_loss = tf.reduce_mean(cross_entropy, name="entropy_loss")
+                if kernel_regularizer is not None:
+                    self.reg_losses += [kernel_regularizer(weights)]
             
-    def finalize(self, optimizer):
+    def _forward(self, X):
+        """
+        Apply all the layers of the stack to an input tensor, sharing the variables of the stack
+        """
+        outputs = X
+        for layer_fn in self._layer_fns:
+            outputs = layer_fn(outputs)
+        return outputs
+
+    def _multi_gpu_training_op(self, optimizer):
+        """
+        Data-parallel training op: each batch is split evenly across the GPUs, each GPU (tower) computes the
+        gradients of the loss on its shard, and the gradients averaged on the CPU are applied once.
+        """
+        assert(self.entropy_loss is not None), "Multi-GPU training requires a softmax output layer"
+        X_shards = tf.split(self.X, self.num_gpus)
+        y_shards = tf.split(self.y, self.num_gpus)
+        tower_grads = []
+        for gpu_idx in range(self.num_gpus):
+            with tf.device("/gpu:{}".format(gpu_idx)), tf.name_scope("tower_{}".format(gpu_idx)):
+                logits = self._forward(X_shards[gpu_idx])
+                cross_entropy = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=y_shards[gpu_idx], logits=logits)
+                tower_loss = tf.add_n([tf.reduce_mean(cross_entropy)] + self.reg_losses)
+                tower_grads += [optimizer.compute_gradients(tower_loss)]
+        with tf.device("/cpu:0"):
+            return optimizer.apply_gradients(average_gradients(tower_grads))
+
+    def finalize(self, optimizer, num_gpus = None):
         """
         Finalize the stack with other information after putting in the output layer
 
         Argument:
         - optimizer: the optimizer to be used
+        - num_gpus: number of GPUs the training batches are split across; all visible GPUs if None
 
         Return: None
         """
         assert(self.graph), "Empty graph"
+        self.num_gpus = max(1, len(gpu_devices()) if num_gpus is None else num_gpus)
         with self.graph.as_default():
+            if self.enable_amp:
+                # Wrapped in the graph of the stack: the loss scale variables are created by the wrapper
+                optimizer = tf.train.experimental.enable_mixed_precision_graph_rewrite(optimizer)
+            # The loss of the output layer and all the regularization losses are summed in a single op
+            output_losses = [loss for loss in [self.reconstruction_loss, self.entropy_loss] if loss is not None]
+            assert(output_losses), "No output layer"
+            self.loss = tf.add_n(output_losses + self.reg_losses, name="loss")
             with tf.variable_scope("training"):
-                self.training_op = optimizer.minimize(self.loss)
+                if self.num_gpus > 1:
+                    self.training_op = self._multi_gpu_training_op(optimizer)
+                else:
+                    self.training_op = optimizer.minimize(self.loss)
             with tf.variable_scope("testing"):
                 self.correct = tf.nn.in_top_k(self.outputs, self.y, 1)
                 self.accuracy = tf.reduce_mean(tf.cast(self.correct, tf.float32))
+            # Tensors that can be evaluated by name (see restore_and_eval)
+            self.varmap = {"loss": self.loss,
+                           "codings": self.encoders[-1],
+                           "hidden_outputs": self.hidden[-1],
+                           "outputs": self.outputs,
+                           "accuracy": self.accuracy,
+                           "correct_prediction": self.correct}
+            if self.reconstruction_loss is not None:
+                self.varmap["reconstruction_loss"] = self.reconstruction_loss
             with tf.variable_scope("summary"):
                 self.loss_summary = tf.summary.scalar("Loss", self.loss)
-                self.summary = tf.summary.merge_all()
+                self.summary = tf.summary.merge([self.loss_summary])
                 tf_log_dir = "{}/{}_run-{}".format(self.tf_log_dir, self.name, timestr())
                 self.train_file_writer = tf.summary.FileWriter(os.path.join(tf_log_dir, "train"), self.graph)
                 self.valid_file_writer = tf.summary.FileWriter(os.path.join(tf_log_dir, "valid"), self.graph)
             with tf.variable_scope("global_initializer"):
                 self.init = tf.global_variables_initializer()
             with tf.variable_scope("saver"):
-                self.saver = tf.train.Saver()
+                self.saver = tf.train.Saver(max_to_keep=None, save_relative_paths=True)
+            # Copy the state of the training session into the validation session (see fit)
+            with tf.variable_scope("snapshot"):
+                self._snapshot_vars = self.graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
+                self._snapshot_inputs = [tf.placeholder(var.dtype.base_dtype, shape=var.shape) for var in self._snapshot_vars]
+                self._load_snapshot = tf.group(*[tf.assign(var, value) for var, value in zip(self._snapshot_vars, self._snapshot_inputs)])
 
     def save(self, model_path):
         """
         Save the model to file
         """
-        with tf.Session(graph=self.graph) as sess:
-            self.init.run()
+        sess = self._get_session()
+        with self.graph.as_default(), sess.as_default():
+            sess.run(self.init, feed_dict=self.init_feed_dict)
             self.saver.save(sess, model_path)
 
     def restore(self, model_path):
@@ -576,14 +844,18 @@ class StackedAutoencoders:
         Restore model's params from file
         """
         assert(self.graph), "Invalid graph"
-        with tf.Session(graph=self.graph) as sess:
+        sess = self._get_session()
+        with self.graph.as_default(), sess.as_default():
             self.saver.restore(sess, model_path)
             self.initial_params = {}
-            self.params = dict([(var.name, var.eval()) for var in tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES)])
+            self.params = _trainable_params(sess, self.graph)
             
-    def fit(self, X_train, X_valid, y_train, y_valid, model_path, save_best_only = True, n_epochs = 1000, batch_size = 256, checkpoint_steps = 100, seed = 42, tfdebug = False):
+    def fit(self, X_train, X_valid, y_train, y_valid, model_path, save_best_only = True, n_epochs = 1000, batch_size = 256, checkpoint_steps = 100, seed = 42, tfdebug = False,
+            eval_batch_size = 10000, min_train_improvement = None):
         """
         Fit the stack with training data; validation set is used to approximate out-of-sample errors during training.
+        The validation (and the saving of the best model) runs in a background thread, in a second session
+        loaded with a snapshot of the model taken at each checkpoint, while training goes on.
 
         Arguments:
         - X_train: features of the training set of shape (n_samples, n_features)
@@ -593,103 +865,133 @@ class StackedAutoencoders:
         - model_path: absolute path to the model file to be saved
         - save_best_only: only save the model when the performance improves (on the validation set)
         - n_epochs: number of epochs to train
-        - batch_size: batch size
+        - batch_size: batch size; every step uses exactly batch_size samples, the rows left over at the end of an epoch are skipped
         - checkpoint_steps: number of steps to record checkpoints and log information
         - seed: random seed for tf
         - tf_debug: turn on to debug in TensorFlow
+        - eval_batch_size: maximum number of validation examples fed per run
+        - min_train_improvement: only validate at a checkpoint if the moving average of the training loss has improved
+          by this relative amount since the last validation; validate at every checkpoint if None
 
         Return: None
         """
         assert(self.training_op is not None), "Invalid self.training_op"
         assert(self.X.shape[1] == X_train.shape[1]), "Invalid input shape"
-        with tf.Session(graph=self.graph) as sess:
+        X_train = np.ascontiguousarray(X_train, dtype=np.float32)
+        X_valid = np.ascontiguousarray(X_valid, dtype=np.float32)
+        sess = self._get_session()
+        with self.graph.as_default(), sess.as_default():
             if tfdebug:
                 sess = tf_debug.LocalCLIDebugWrapperSession(sess)
             if batch_size is None:
                 batch_size = len(X_train)
+            assert(batch_size % self.num_gpus == 0), "Batch size must be a multiple of the number of GPUs"
             tf.set_random_seed(seed)
-            self.init.run()
-            self.initial_params = dict([(var.name, var.eval()) for var in tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES)])
+            sess.run(self.init, feed_dict=self.init_feed_dict)
+            self.initial_params = _trainable_params(sess, self.graph)
             best_loss_on_valid_set = 100000
             model_step = -1
             stop = False
-            for epoch in tqdm(range(n_epochs)):
-                X_train_indices = np.random.permutation(len(X_train))
-                n_batches = len(X_train) // batch_size
-                start_idx = 0
-                for batch_idx in range(n_batches):
-                    indices = X_train_indices[start_idx : start_idx + batch_size]
-                    X_batch = X_train[indices]
-                    y_batch = y_train[indices]
-                    sess.run(self.training_op, feed_dict={self.X: X_batch, self.y: y_batch, self.training: True})                    
-                    step = epoch * n_batches + batch_idx
-                    if step % checkpoint_steps == 0:
-                        train_summary = sess.run(self.summary, feed_dict={self.X: X_batch, self.y: y_batch})
-                        self.train_file_writer.add_summary(train_summary, step)
-                        loss_on_valid_set, loss_summary_on_valid_set = sess.run([self.loss, self.loss_summary],
-                                                                                feed_dict={self.X: X_valid, self.y: y_valid})
-                        self.valid_file_writer.add_summary(loss_summary_on_valid_set, step)
-                        model_to_save = (not save_best_only) or (loss_on_valid_set < best_loss_on_valid_set)
-                        if loss_on_valid_set < best_loss_on_valid_set:
-                            best_loss_on_valid_set = loss_on_valid_set
-                        if model_to_save:
-                            self.saver.save(sess, model_path)
-                            model_step = step
-                        if os.path.exists(self.stop_file_path):
-                            stop = True
-                    start_idx += batch_size
-                if stop:
-                    print("Stopping command detected: {}".format(self.stop_file_path))
-                    break
-            self.params = dict([(var.name, var.eval()) for var in tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES)])
+            n_batches = len(X_train) // batch_size
+            assert(n_batches > 0), "Batch size larger than the training set"
+            sess.run(self.train_iterator.initializer, feed_dict={self.X_train_full: X_train,
+                                                                 self.y_train_full: y_train,
+                                                                 self.batch_size: batch_size,
+                                                                 self.shuffle_seed: seed})
+            train_feed_dict = {self.training: True}
+            train_step = sess.make_callable(self.training_op, feed_list=[self.training])
+            valid_inputs = {self.X: X_valid, self.y: y_valid}
+            # The training summary comes from the forward pass of the training step itself, and the validation
+            # accuracy from the forward pass of the validation loss
+            train_checkpoint_fetches = [self.training_op, self.summary, self.loss]
+            valid_checkpoint_fetches = [self.loss, self.accuracy]
+            valid_gate = _ValidationGate(min_train_improvement)
+            valid_sess = tf.Session(graph=self.graph, config=self.session_config)
+            stop_watcher = StopFileWatcher(self.stop_file_path).start()
+            def validate(snapshot, step):
+                nonlocal best_loss_on_valid_set, model_step
+                valid_sess.run(self._load_snapshot, feed_dict=dict(zip(self._snapshot_inputs, snapshot)))
+                loss_on_valid_set, accuracy_on_valid_set = _run_in_batches(valid_sess, valid_checkpoint_fetches, valid_inputs, eval_batch_size)
+                valid_summary = tf.Summary(value=[tf.Summary.Value(tag="Loss", simple_value=loss_on_valid_set),
+                                                  tf.Summary.Value(tag="Accuracy", simple_value=accuracy_on_valid_set)])
+                self.valid_file_writer.add_summary(valid_summary, step)
+                model_to_save = (not save_best_only) or (loss_on_valid_set < best_loss_on_valid_set)
+                if loss_on_valid_set < best_loss_on_valid_set:
+                    best_loss_on_valid_set = loss_on_valid_set
+                if model_to_save:
+                    first_save = model_step < 0
+                    self.saver.save(valid_sess, model_path, write_meta_graph=first_save, write_state=first_save)
+                    model_step = step
+            try:
+                validation = None
+                with ThreadPoolExecutor(max_workers=1) as executor:
+                    for epoch in tqdm(range(n_epochs)):
+                        for batch_idx in range(n_batches):
+                            step = epoch * n_batches + batch_idx
+                            if step % checkpoint_steps != 0:
+                                train_step(True)
+                            else:
+                                _, train_summary, train_loss = sess.run(train_checkpoint_fetches, feed_dict=train_feed_dict)
+                                self.train_file_writer.add_summary(train_summary, step)
+                                valid_gate.update(train_loss)
+                                if valid_gate.should_validate():
+                                    # Only wait if the previous validation is still running
+                                    if validation is not None:
+                                        validation.result()
+                                    validation = executor.submit(validate, sess.run(self._snapshot_vars), step)
+                                if stop_watcher.is_set():
+                                    stop = True
+                        if stop:
+                            print("Stopping command detected: {} or SIGUSR1".format(self.stop_file_path))
+                            break
+                    if validation is not None:
+                        validation.result()
+            finally:
+                valid_sess.close()
+                stop_watcher.close()
+            self.params = _trainable_params(sess, self.graph)
             self.train_file_writer.close()
             self.valid_file_writer.close()
             assert(model_step >= 0), "Invalid model step"
             all_steps = n_epochs * n_batches
             return model_step, all_steps
 
-    def restore_and_eval(self, model_path, X, y = None, varlist = [], tfdebug = False):
+    def restore_and_eval(self, model_path, X, y = None, varlist = [], tfdebug = False, eval_batch_size = 10000):
         """
         Restore model's params and evaluate variables
 
         Arguments:
-        - X: the input to be fed into the network
-        - varlist: list of variables to evaluate. Valid values: "loss", "reconstruction_loss", "hidden_outputs", "outputs"
+        - X: the input to be fed into the network, or a list of inputs evaluated after a single restoration
+        - y: the targets of X (a list of targets for a list of inputs); only needed for "accuracy"
+        - varlist: list of variables to evaluate. Valid values: "loss", "codings", "hidden_outputs", "outputs", "accuracy",
+          "correct_prediction", and "reconstruction_loss" if a reconstruction layer was stacked
+        - eval_batch_size: maximum number of examples fed per run
 
-        Return: a list of evaluated variables
-
-        TODO: extend X to also accept a list of inputs; useful when evaluate with training and test sets so that 
-        the network needs to be restored once
+        Return: a list of evaluated variables; for a list of inputs, the variables of the first input, then those
+        of the second input, etc.
         """
         assert(self.graph), "Invalid graph"
-        with tf.Session(graph=self.graph) as sess:
+        sess = self._get_session()
+        with self.graph.as_default(), sess.as_default():
             self.saver.restore(sess, model_path)
-            self.params = dict([(var.name, var.eval()) for var in tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES)])
+            self.params = _trainable_params(sess, self.graph)
             if tfdebug:
                 sess = tf_debug.LocalCLIDebugWrapperSession(sess)
             if not varlist:
                 return []
             assert(X is not None), "Invalid input samples"
-            varmap = {"loss": self.loss,
-                      "hidden_outputs": self.hidden[-1],
-                      "outputs": self.outputs,
-                      "accuracy": self.accuracy}
-            vars_to_eval = []
-            for var in varlist:
-                # The order of var in the list needs to be kept, thus this for-loop
-                if var == "loss":
-                    vars_to_eval += [self.loss]
-                elif var == "codings":
-                    vars_to_eval += [self.encoders[-1]]
-                elif var == "outputs":
-                    vars_to_eval += [self.outputs]
-                elif var == "accuracy":
-                    assert(len(X) == len(y)), "Invalid examples and targets sizes"
-                    vars_to_eval += [self.accuracy]
-                elif var == "correct_prediction":
-                    vars_to_eval += [self.correct]
-            y = np.zeros((len(X), 1)) if y is None else y
-            return sess.run(vars_to_eval, feed_dict={self.X: X, self.y: y})
+            Xs = X if isinstance(X, list) else [X]
+            ys = y if isinstance(y, list) else [y] * len(Xs)
+            assert(len(Xs) == len(ys)), "Invalid number of targets"
+            vars_to_eval = [self.varmap[var] for var in varlist]
+            values = []
+            for X, y in zip(Xs, ys):
+                X = np.ascontiguousarray(X, dtype=np.float32)
+                if "accuracy" in varlist:
+                    assert(y is not None and len(X) == len(y)), "Invalid examples and targets sizes"
+                y = np.zeros((len(X), 1)) if y is None else y
+                values += _run_in_batches(sess, vars_to_eval, {self.X: X, self.y: y}, eval_batch_size)
+            return values
         
     def get_codings(self, model_path, X, file_path = None):
         """
@@ -697,7 +999,7 @@ class StackedAutoencoders:
 
         Arguments:
         - X: the input to be fed into the network with shape (n_examples, n_features)
-        - file_path (optional): path to a csv file for storing the resulting codings
+        - file_path (optional): path to a parquet file for storing the resulting codings
 
         Return: the codings of X with shape (n_examples, n_new_features)
         """
@@ -706,7 +1008,7 @@ class StackedAutoencoders:
         if file_path is not None:
             columns = ["f_{}".format(idx) for idx in range(X_codings.shape[1])]
             df = pd.DataFrame(data=X_codings, columns=columns)
-            df.to_csv(file_path)
+            df.to_parquet(file_path, engine="pyarrow", compression="snappy")
         return X_codings
 
         
@@ -731,6 +1033,7 @@ class StackBuilder:
                  stack_regularizer=None,
                  stack_input_dropout_rate = 0,
                  stack_hidden_dropout_rate = [],
+                 stack_trainable_layers = [],
                  unit_hidden_activations = tf.nn.softmax, # of hidden layers
                  unit_output_activations = None,          # of hidden layers
                  output_activation = tf.nn.softmax, # of output layer
@@ -739,7 +1042,9 @@ class StackBuilder:
                  output_bias_initializer = tf.zeros_initializer(),
                  optimizer = tf.train.AdamOptimizer(5*1e-6),
                  cache_dir = "../cache",
-                 tf_log_dir = "../tf_logs"):
+                 tf_log_dir = "../tf_logs",
+                 enable_amp = False,
+                 session_config = None):
         """
         Ctor
         
@@ -750,6 +1055,11 @@ class StackBuilder:
         - n_neurons_per_layer: array of number of hidden neurons after the reused units
         - noise_stddev: array of noise_stddev to be used for new units after the reused ones
         - dropout_rate: similar to noise_stddev array
+        - stack_trainable_layers: array of booleans telling whether each hidden layer of the stack is fine-tuned
+          (frozen layers are embedded as constants);
+          layers beyond the array are fine-tuned
+        - enable_amp: train the units and the stack with automatic mixed precision; process-wide in TF1 (see UnitAutoencoder)
+        - session_config: tf.ConfigProto of the sessions of the units and the stack; default_session_config() if None
 
         """
         self.name = name
@@ -772,6 +1082,8 @@ class StackBuilder:
         self.stack_input_dropout_rate = stack_input_dropout_rate
         self.stack_hidden_dropout_rate = stack_hidden_dropout_rate
         assert(len(self.stack_hidden_dropout_rate) <= self.n_hidden_layers), "Invalid hidden dropout rate"        
+        self.stack_trainable_layers = stack_trainable_layers
+        assert(len(self.stack_trainable_layers) <= self.n_hidden_layers), "Invalid trainable layers array"
         self.unit_model_paths = [None] * self.n_hidden_layers
         self.units = [None] * self.n_hidden_layers
         self.unit_hidden_activations = unit_hidden_activations
@@ -783,6 +1095,8 @@ class StackBuilder:
         self.optimizer = optimizer
         self.cache_dir = cache_dir
         self.tf_log_dir = tf_log_dir
+        self.enable_amp = enable_amp
+        self.session_config = session_config
         self.stack_cache_dir = os.path.join(self.cache_dir, "stack")
         self.stack_tf_log_dir = os.path.join(self.tf_log_dir, "stack")
         self.stack_model_path = os.path.join(self.stack_cache_dir, self.name) + ".model"
@@ -791,7 +1105,7 @@ class StackBuilder:
     def _save_X(self, X, file_path):
         columns = ["f_{}".format(idx) for idx in range(X.shape[1])]
         df = pd.DataFrame(data=X, columns=columns)
-        df.to_csv(file_path)
+        df.to_parquet(file_path, engine="pyarrow", compression="snappy")
 
     def get_stack(self):
         return self.stack
@@ -817,7 +1131,7 @@ class StackBuilder:
         units = []
         X_train_current = X_train
         X_valid_current = X_valid
-        rows = {}
+        rows = []
         for hidden_layer in range(self.n_hidden_layers):
             unit_name = "Unit_{}".format(hidden_layer)
             unit_cache_dir = os.path.join(self.cache_dir, unit_name)
@@ -844,11 +1158,15 @@ class StackBuilder:
                                    output_activation = self.unit_output_activations,
                                    n_observable_hidden_neurons = n_observable_hidden_neurons_per_layer,
                                    optimizer = self.optimizer,
-                                   tf_log_dir = unit_tf_log_dir)
+                                   tf_log_dir = unit_tf_log_dir,
+                                   params_dir = os.path.join(unit_cache_dir, "params"),
+                                   enable_amp = self.enable_amp,
+                                   session_config = self.session_config)
             
             # Try to reuse trained model if specified
             unit_model_path = self.preceding_unit_model_paths[hidden_layer] if hidden_layer < len(self.preceding_units) else os.path.join(unit_cache_dir, "{}.model".format(unit_name))
-            if not os.path.exists("{}.meta".format(unit_model_path)):
+            is_new_model = not os.path.exists("{}.meta".format(unit_model_path))
+            if is_new_model:
                 if pretrained_weight_initialization:
                     print("Training {} for hidden layer {}...\n".format(unit_name, hidden_layer))
                     model_step, all_steps = unit.fit(X_train_current,
@@ -865,9 +1183,21 @@ class StackBuilder:
                     unit.save_untrained_model(model_path=unit_model_path, seed=seed)
                     model_step, all_steps = (0, 0)
                     print(">> Done\n")
+            else:
+                print("Reloading model {} of {} for hidden layer {}...\n".format(unit_model_path, unit_name, hidden_layer))
+                model_step, all_steps = 0, 0
+            # Restore the model once, and evaluate it on both the training and validation sets
+            [train_reconstruction_loss, X_train_codings,
+             valid_reconstruction_loss, X_valid_codings] = unit.restore_and_eval([X_train_current, X_valid_current], unit_model_path,
+                                                                                 ["reconstruction_loss", "hidden_outputs"])
+            # The reconstructed outputs are only plotted for a new model: the session still holds the restored params
+            X_recon = unit.eval(X_train_current, ["outputs"])[0] if is_new_model else None
+            # The stack only needs the params of the unit (memory-mapped from params_dir): release its session,
+            # its copy of the training set and its device memory
+            unit.close()
+            if is_new_model:
                 print("Plotting reconstructed outputs of unit at hidden layer {}...\n".format(hidden_layer))
                 unit_plot_dir = os.path.join(unit_cache_dir, "plots")
-                [X_recon] = unit.restore_and_eval(X_train_current, unit_model_path, ["outputs"])
                 assert(X_recon.shape == X_train_current.shape), "Invalid output shape"
                 unit_reconstructed_dir = os.path.join(unit_plot_dir, "reconstructed")
                 plot_reconstructed_outputs(X_train_current, y_train, X_recon, size_per_class=n_reconstructed_examples_per_class_to_plot,
@@ -878,31 +1208,28 @@ class StackBuilder:
                 unit_hidden_weights_dir = os.path.join(unit_plot_dir, "hidden_weights")
                 plot_hidden_weights(hidden_weights, n_hidden_neurons_to_plot, unit_hidden_weights_dir, seed =seed+20)
                 print(">> Done\n")
-            else:
-                print("Reloading model {} of {} for hidden layer {}...\n".format(unit_model_path, unit_name, hidden_layer))
-                unit.restore(unit_model_path)
-                model_step, all_steps = 0, 0
-                print(">> Done\n")
             self.unit_model_paths[hidden_layer] = unit_model_path # This can be passed to subsequent stack built upon this one
             self.units[hidden_layer] = unit
-            self._save_X(X_train_current, os.path.join(unit_cache_dir, "X_train_layer_{}.csv".format(hidden_layer)))
-            self._save_X(X_valid_current, os.path.join(unit_cache_dir, "X_valid_layer_{}.csv".format(hidden_layer)))
-            [train_reconstruction_loss, X_train_current] = unit.restore_and_eval(X_train_current, unit_model_path, ["reconstruction_loss", "hidden_outputs"])
-            [valid_reconstruction_loss, X_valid_current] = unit.restore_and_eval(X_valid_current, unit_model_path, ["reconstruction_loss", "hidden_outputs"])
-            rows[hidden_layer] = [train_reconstruction_loss, valid_reconstruction_loss, model_step, all_steps, unit_model_path]
+            self._save_X(X_train_current, os.path.join(unit_cache_dir, "X_train_layer_{}.parquet".format(hidden_layer)))
+            self._save_X(X_valid_current, os.path.join(unit_cache_dir, "X_valid_layer_{}.parquet".format(hidden_layer)))
+            X_train_current, X_valid_current = X_train_codings, X_valid_codings
+            rows.append((train_reconstruction_loss, valid_reconstruction_loss, model_step, all_steps, unit_model_path))
             
         print("Stacking up pretrained units...\n")
-        self.stack = StackedAutoencoders(name=self.name, cache_dir=self.stack_cache_dir, tf_log_dir=self.stack_tf_log_dir)
+        self.stack = StackedAutoencoders(name=self.name, cache_dir=self.stack_cache_dir, tf_log_dir=self.stack_tf_log_dir,
+                                         enable_amp=self.enable_amp, session_config=self.session_config)
         if (not ordinary_stack):
             stack_hidden_layer_names = ["{}_hidden_{}".format(self.name, str(idx)) for idx in range(len(self.units))]
             for idx, unit in enumerate(self.units):
                 stack_input_dropout_rate = self.stack_input_dropout_rate if idx == 0 else 0
                 stack_hidden_dropout_rate = self.stack_hidden_dropout_rate[idx] if idx < len(self.stack_hidden_dropout_rate) else 0
                 stack_regularizer = self.stack_regularizer
+                trainable = self.stack_trainable_layers[idx] if idx < len(self.stack_trainable_layers) else True
                 self.stack.stack_encoder(unit, stack_hidden_layer_names[idx],
                                          regularizer=stack_regularizer,
                                          input_dropout_rate=stack_input_dropout_rate,
-                                         hidden_dropout_rate=stack_hidden_dropout_rate)
+                                         hidden_dropout_rate=stack_hidden_dropout_rate,
+                                         trainable=trainable)
             n_classes = len(set(y_train))
             self.stack.stack_softmax_output_layer(layer_name="{}_softmax_outputs".format(self.name),
                                                   n_classes=n_classes,
@@ -933,10 +1260,8 @@ class StackBuilder:
         result_file_path = os.path.join(self.stack_cache_dir, "hidden_layer_units.csv")
         print("Saving results of building hidden layer units to {}...\n".format(result_file_path))
         columns = ["train_reconstruction_loss", "valid_reconstruction_loss", "step_of_best_model", "all_steps", "unit_model_path"]
-        df = pd.DataFrame.from_dict(rows, orient="index")
+        df = pd.DataFrame(rows, columns=columns)
         df.index.name = "hidden_layer"
-        df.columns = columns
-        df.sort_index(inplace=True)
         df.to_csv(result_file_path)
         print(">> Done\n")
                 
@@ -946,6 +1271,134 @@ class StackBuilder:
 ## Supporting functions
 ##
 ##################################################################################
+def _trainable_params(sess, graph):
+    """
+    Fetch the values of all trainable variables of a graph in a single run
+
+    Return: dictionary with variable names as keys and their values as values
+    """
+    variables = graph.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES)
+    return dict(zip([var.name for var in variables], sess.run(variables)))
+
+def _save_neurons_csv(W, file_path):
+    """
+    Save a matrix with one column per neuron to a csv file, with a header naming the neurons
+    """
+    header = ",".join(["neuron_{}".format(idx) for idx in range(W.shape[1])])
+    np.savetxt(file_path, W, delimiter=",", header=header, comments="")
+
+def _dense(inputs, weights, biases, activation = None):
+    """
+    Dense layer spelled out as MatMul + BiasAdd (+ activation) so that Grappler's remapper can fuse it into
+    a single _FusedMatMul kernel; reused with pretrained variables, unlike tf.layers.dense
+    """
+    outputs = tf.nn.bias_add(tf.matmul(inputs, weights), biases)
+    return activation(outputs) if activation is not None else outputs
+
+def _run_in_batches(sess, fetches, inputs, batch_size):
+    """
+    Evaluate tensors over a large set of examples a chunk of rows at a time, so that no run has to
+    materialize the activations of the whole set at once
+
+    Arguments:
+    - fetches: list of tensors; scalars must be means over the examples (losses, accuracy), the others
+      must have one row per example
+    - inputs: dictionary mapping placeholders to arrays sharing the same number of rows
+    - batch_size: maximum number of rows fed per run
+
+    Return: list of values of the fetches over the whole set; scalars are averaged weighted by chunk sizes,
+    the others are concatenated
+    """
+    n_samples = len(next(iter(inputs.values())))
+    if n_samples <= batch_size:
+        return sess.run(fetches, feed_dict=inputs)
+    chunks = []
+    for start_idx in range(0, n_samples, batch_size):
+        feed_dict = {tensor: value[start_idx:start_idx + batch_size] for tensor, value in inputs.items()}
+        chunks += [(len(next(iter(feed_dict.values()))), sess.run(fetches, feed_dict=feed_dict))]
+    results = []
+    for fetch_idx in range(len(fetches)):
+        values = [values[fetch_idx] for _, values in chunks]
+        if np.ndim(values[0]) == 0:
+            results += [sum(n_rows * value for (n_rows, _), value in zip(chunks, values)) / n_samples]
+        else:
+            results += [np.concatenate(values)]
+    return results
+
+class _ValidationGate:
+    """
+    Cheap gate in front of the validation at checkpoints: it opens when the moving average of the training loss
+    (over the checkpoints) has improved by more than a relative min_improvement since it was last open, so that
+    plateaus of the training loss do not trigger full passes over the validation set
+    """
+    def __init__(self, min_improvement, decay = 0.9):
+        """
+        Arguments:
+        - min_improvement: minimum relative improvement of the moving average; the gate is always open if None
+        - decay: decay of the moving average
+        """
+        self.min_improvement = min_improvement
+        self.decay = decay
+        self.train_loss_ema = None
+        self.best_train_loss_ema = np.inf
+
+    def update(self, train_loss):
+        self.train_loss_ema = train_loss if self.train_loss_ema is None else self.decay * self.train_loss_ema + (1 - self.decay) * train_loss
+
+    def should_validate(self):
+        if self.min_improvement is None or self.train_loss_ema is None:
+            return True
+        if self.train_loss_ema < self.best_train_loss_ema * (1 - self.min_improvement):
+            self.best_train_loss_ema = self.train_loss_ema
+            return True
+        return False
+
+def average_gradients(tower_grads):
+    """
+    Average the gradients computed by several towers
+
+    Arguments:
+    - tower_grads: list (over towers) of lists of (gradient, variable) pairs, as returned by compute_gradients;
+      all towers list the variables in the same order
+
+    Return: list of (averaged gradient, variable) pairs
+    """
+    average_grads = []
+    for grads_and_vars in zip(*tower_grads):
+        grads = [grad for grad, _ in grads_and_vars if grad is not None]
+        grad = tf.reduce_mean(tf.stack(grads), axis=0) if grads else None
+        average_grads += [(grad, grads_and_vars[0][1])]
+    return average_grads
+
+# Upper bound on the number of examples held by the shuffle buffer of the training pipeline
+_MAX_SHUFFLE_BUFFER_SIZE = 100000
+
+def _make_train_iterator(tensors, batch_size, seed):
+    """
+    Build the input pipeline used for training: the in-memory tensors are reshuffled at every epoch
+    and served in batches of exactly batch_size rows (the remaining rows of each epoch are dropped).
+    Sets larger than _MAX_SHUFFLE_BUFFER_SIZE are shuffled through a bounded buffer rather than fully.
+
+    Arguments:
+    - tensors: a tensor or a tuple of tensors sharing the same first dimension, usually placeholders
+      fed once when the iterator is initialized
+    - batch_size: scalar int64 tensor
+    - seed: scalar int64 tensor seeding the shuffling, so that runs with the same seed see the same batches
+
+    Return: an initializable iterator that repeats indefinitely
+    """
+    first = tensors[0] if isinstance(tensors, tuple) else tensors
+    n_samples = tf.shape(first, out_type=tf.int64)[0]
+    dataset = tf.data.Dataset.from_tensor_slices(tensors)
+    buffer_size = tf.minimum(n_samples, _MAX_SHUFFLE_BUFFER_SIZE)
+    dataset = dataset.shuffle(buffer_size, seed=seed, reshuffle_each_iteration=True).batch(batch_size, drop_remainder=True).repeat()
+    if gpu_devices():
+        # Stage the next batches on the GPU so the host-to-device copy overlaps the current step
+        dataset = dataset.apply(tf.data.experimental.prefetch_to_device("/gpu:0", buffer_size=2))
+    else:
+        dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+    return dataset.make_initializable_iterator()
+
 def generate_unit_autoencoders(X_train,
                                X_valid,
                                y_train,
@@ -968,7 +1421,8 @@ def generate_unit_autoencoders(X_train,
                                n_reconstructed_examples_per_class_to_plot = 20,
                                seed = 0,                       
                                cache_dir = "../cache",
-                               tf_log_dir = "../tf_logs"):
+                               tf_log_dir = "../tf_logs",
+                               n_parallel_units = 1):
     n_inputs = X_train.shape[1]
     if not os.path.exists(cache_dir):
         os.makedirs(cache_dir)
@@ -978,52 +1432,81 @@ def generate_unit_autoencoders(X_train,
         prefix = "dropout"
     else:
         prefix = "ordinary"
-    all_run_rows = {}
-    all_run_idx = 0
-    avg_recon_loss_rows = {}
-    all_indices = list(np.random.permutation(len(X_train)))
+    all_run_rows = []
+    avg_recon_loss_rows = []
+    # Permute the rows once: the held-out rows of each fold are then a contiguous slice (a view), and
+    # the training rows are the two remaining slices copied into a buffer allocated once
+    all_indices = np.random.permutation(len(X_train))
+    X_shuffled = X_train[all_indices]
+    y_shuffled = y_train[all_indices]
     fold_sz = len(all_indices) // n_folds
-    for n_neurons in n_neurons_range:
+    X_fold_train = np.empty((len(all_indices) - fold_sz,) + X_train.shape[1:], dtype=X_train.dtype)
+    y_fold_train = np.empty((len(all_indices) - fold_sz,) + y_train.shape[1:], dtype=y_train.dtype)
+    def fold_rows(fold_idx):
+        fold_start_idx = int(fold_idx * fold_sz)
+        fold_end_idx = min(fold_start_idx + fold_sz, len(all_indices))
+        if fold_end_idx - fold_start_idx == len(all_indices):
+            return fold_start_idx, fold_end_idx, X_shuffled, y_shuffled
+        np.copyto(X_fold_train[:fold_start_idx], X_shuffled[:fold_start_idx])
+        np.copyto(X_fold_train[fold_start_idx:], X_shuffled[fold_end_idx:])
+        np.copyto(y_fold_train[:fold_start_idx], y_shuffled[:fold_start_idx])
+        np.copyto(y_fold_train[fold_start_idx:], y_shuffled[fold_end_idx:])
+        return fold_start_idx, fold_end_idx, X_fold_train, y_fold_train
+    # Scale the folds once: the scaled sets (and the scaler fitted on each fold) are reused for every n_neurons
+    scaled_folds = []
+    for fold_idx in range(n_folds):
+        fold_start_idx, fold_end_idx, X_fold, _ = fold_rows(fold_idx)
+        fold_scaler = clone(scaler).fit(X_fold)
+        scaled_folds += [(fold_scaler,
+                          np.ascontiguousarray(fold_scaler.transform(X_fold), dtype=np.float32),
+                          np.ascontiguousarray(fold_scaler.transform(X_valid), dtype=np.float32),
+                          np.ascontiguousarray(fold_scaler.transform(X_shuffled[fold_start_idx:fold_end_idx]), dtype=np.float32))]
+    if not os.path.exists(tf_log_dir):
+        os.makedirs(tf_log_dir)
+    # Units of different n_neurons are independent: up to n_parallel_units of them are trained at the same time,
+    # each in its own graph and session sharing the CPU cores (sess.run releases the GIL)
+    session_config = default_session_config(intra_op_parallelism_threads=max(1, os.cpu_count() // n_parallel_units))
+    # Serializes the graph construction (the optimizer is shared), and the use of the fold buffers and of pyplot
+    construction_lock = threading.Lock()
+    plot_lock = threading.Lock()
+    def train_folds(n_neurons):
         avg_recon_loss = 0
-        for fold_idx in range(n_folds):
-            unit_name = config_str(prefix,
-                                   n_epochs=n_epochs,
-                                   n_inputs=n_inputs,
-                                   n_neurons=n_neurons,
-                                   hidden_activation=hidden_activation,
-                                   regularizer_value=regularizer_value,
-                                   noise_stddev=noise_stddev,
-                                   dropout_rate=dropout_rate)
-            unit_name += "_fold{}".format(fold_idx)
-            print("\n\n*** Constructing and training unit {}, fold {}/{} ***".format(unit_name, fold_idx+1, n_folds))
-            unit_cache_dir = os.path.join(cache_dir, unit_name)
-            if not os.path.exists(unit_cache_dir):
-                os.makedirs(unit_cache_dir)
-            unit_tf_log_dir = tf_log_dir
-            if not os.path.exists(unit_tf_log_dir):
-                os.makedirs(unit_tf_log_dir)
-            unit_regularizer = tf.contrib.layers.l2_regularizer(regularizer_value) if regularizer_value is not None else None
-            unit = UnitAutoencoder(unit_name,
+        run_rows = []
+        base_unit_name = config_str(prefix,
+                                    n_epochs=n_epochs,
+                                    n_inputs=n_inputs,
+                                    n_neurons=n_neurons,
+                                    hidden_activation=hidden_activation,
+                                    regularizer_value=regularizer_value,
+                                    noise_stddev=noise_stddev,
+                                    dropout_rate=dropout_rate)
+        # One graph and session per n_neurons: every fit reinitializes all the variables (optimizer slots included).
+        # The variables of every fold are thus scoped by base_unit_name, while the model files (and the model_name
+        # of the results) are named base_unit_name + "_fold<fold_idx>"
+        unit_regularizer = tf.contrib.layers.l2_regularizer(regularizer_value) if regularizer_value is not None else None
+        with construction_lock:
+            unit = UnitAutoencoder(base_unit_name,
                                    n_inputs,
                                    n_neurons,
                                    n_observable_hidden_neurons=n_observable_hidden_neurons,
                                    noise_stddev=noise_stddev,
-                                   dropout_rate=dropout_rate,
+                                   input_dropout_rate=dropout_rate,
                                    hidden_activation=hidden_activation,
                                    output_activation=output_activation,
                                    regularizer=unit_regularizer,
                                    initializer=initializer,
                                    optimizer=optimizer,                               
-                                   tf_log_dir=unit_tf_log_dir)
+                                   tf_log_dir=tf_log_dir,
+                                   session_config=session_config)
+        for fold_idx in range(n_folds):
+            unit_name = "{}_fold{}".format(base_unit_name, fold_idx)
+            print("\n\n*** Training unit {}, fold {}/{} ***".format(unit_name, fold_idx+1, n_folds))
+            unit_cache_dir = os.path.join(cache_dir, unit_name)
+            if not os.path.exists(unit_cache_dir):
+                os.makedirs(unit_cache_dir)
+            unit.open_file_writers(run_name=unit_name)
             unit_model_path = os.path.join(unit_cache_dir, "{}.model".format(unit_name))
-            fold_start_idx = int(fold_idx * fold_sz)
-            fold_end_idx = min(fold_start_idx + fold_sz, len(all_indices))
-            if fold_end_idx - fold_start_idx == len(all_indices):
-                X_train_indices = range(len(all_indices))
-            else:
-                X_train_indices = all_indices[:fold_start_idx] + all_indices[fold_end_idx:]
-            X_train_scaled = scaler.fit_transform(X_train[X_train_indices])
-            X_valid_scaled = scaler.transform(X_valid)
+            fold_scaler, X_train_scaled, X_valid_scaled, X_remaining_scaled = scaled_folds[fold_idx]
             model_step = unit.fit(X_train_scaled,
                                   X_valid_scaled,
                                   n_epochs=n_epochs,
@@ -1033,46 +1516,64 @@ def generate_unit_autoencoders(X_train,
                                   seed=seed)
             print("\n>> Model {} saved at step {}\n".format(unit_model_path, model_step))
             [reconstruction_loss, outputs] = unit.restore_and_eval(X_train_scaled, unit_model_path, ["reconstruction_loss", "outputs"])
-            all_run_row = [n_neurons, fold_idx, reconstruction_loss, unit_name]
-            all_run_rows[all_run_idx] = all_run_row
-            all_run_idx += 1
+            run_rows.append((n_neurons, fold_idx, reconstruction_loss, unit_name))
             assert(outputs.shape == X_train_scaled.shape), "Invalid output shape"
             unit_plot_dir = os.path.join(unit_cache_dir, "plots")
             unit_reconstructed_dir = os.path.join(unit_plot_dir, "reconstructed")
-            X_recon = scaler.inverse_transform(outputs)
-            plot_reconstructed_outputs(X_train[X_train_indices], y_train[X_train_indices], X_recon, size_per_class=n_reconstructed_examples_per_class_to_plot,
-                                       plot_dir_path=unit_reconstructed_dir, seed=seed+10)
+            X_recon = fold_scaler.inverse_transform(outputs)
             hidden_weights = unit.hidden_weights()
             unit_hidden_weights_dir = os.path.join(unit_plot_dir, "hidden_weights")
-            plot_hidden_weights(hidden_weights, n_hidden_neurons_to_plot, unit_hidden_weights_dir, seed =seed+20)
+            with plot_lock:
+                _, _, X_fold, y_fold = fold_rows(fold_idx)
+                plot_reconstructed_outputs(X_fold, y_fold, X_recon, size_per_class=n_reconstructed_examples_per_class_to_plot,
+                                           plot_dir_path=unit_reconstructed_dir, seed=seed+10)
+                plot_hidden_weights(hidden_weights, n_hidden_neurons_to_plot, unit_hidden_weights_dir, seed =seed+20)
 
             # Cross validation on the remaining examples
-            X_remaining_indices = all_indices[fold_start_idx:fold_end_idx]
-            X_remaining_scaled = scaler.transform(X_train[X_remaining_indices])
             [valid_reconstruction_loss] = unit.restore_and_eval(X_remaining_scaled, unit_model_path, ["reconstruction_loss"])
             avg_recon_loss += valid_reconstruction_loss
-        avg_recon_loss /= n_folds
-        avg_recon_loss_rows[n_neurons] = [avg_recon_loss]
+        unit.close()
+        return run_rows, avg_recon_loss / n_folds
+    if n_parallel_units > 1:
+        with ThreadPoolExecutor(max_workers=n_parallel_units) as executor:
+            results = list(executor.map(train_folds, n_neurons_range))
+    else:
+        # Serial sweep in the calling thread, where the stop signal handler can be installed (see StopFileWatcher)
+        results = [train_folds(n_neurons) for n_neurons in n_neurons_range]
+    for n_neurons, (run_rows, avg_recon_loss) in zip(n_neurons_range, results):
+        all_run_rows += run_rows
+        avg_recon_loss_rows.append((n_neurons, avg_recon_loss))
             
     columns = ["n_neurons", "fold_idx", "reconstruction_loss", "model_name"]
-    all_runs_df = pd.DataFrame.from_dict(all_run_rows, orient="index")
+    all_runs_df = pd.DataFrame(all_run_rows, columns=columns)
     all_runs_df.index.name = "Idx"
-    all_runs_df.columns = columns
+    # Results of previous sweeps are kept: only the rows of this sweep are appended
+    result_file_path = os.path.join(cache_dir, "results_all_runs.csv")
+    all_runs_df.to_csv(result_file_path, mode="a", header=not os.path.exists(result_file_path))
+
+    columns = ["n_neurons", "reconstruction_loss"]
+    avg_df = pd.DataFrame(avg_recon_loss_rows, columns=columns).set_index("n_neurons")
+    result_file_path = os.path.join(cache_dir, "results_avg.csv")
+    avg_df.to_csv(result_file_path, mode="a", header=not os.path.exists(result_file_path))
+    
+
+def sort_unit_results(cache_dir):
+    """
+    Sort the results appended by the sweeps of generate_unit_autoencoders, once at the end of an experiment:
+    all the runs by n_neurons and fold (renumbering their Idx), and the averages by n_neurons
+
+    Arguments:
+    - cache_dir: the cache directory of the sweeps
+
+    Return: None
+    """
     result_file_path = os.path.join(cache_dir, "results_all_runs.csv")
     if os.path.exists(result_file_path):
-        existing_df = pd.DataFrame.from_csv(result_file_path, index_col = 0)
-        all_runs_df = all_runs_df.append(existing_df)
-    all_runs_df.sort_index(inplace=True)
-    all_runs_df.to_csv(result_file_path)
-
-    columns = ["reconstruction_loss"]
-    avg_df = pd.DataFrame.from_dict(avg_recon_loss_rows, orient="index")
-    avg_df.index.name = "n_neurons"
-    avg_df.columns = columns
+        all_runs_df = pd.read_csv(result_file_path, index_col=0)
+        all_runs_df = all_runs_df.sort_values(["n_neurons", "fold_idx"], kind="mergesort").reset_index(drop=True)
+        all_runs_df.index.name = "Idx"
+        all_runs_df.to_csv(result_file_path)
     result_file_path = os.path.join(cache_dir, "results_avg.csv")
     if os.path.exists(result_file_path):
-        existing_df = pd.DataFrame.from_csv(result_file_path, index_col = 0)
-        avg_df = avg_df.append(existing_df)
-    avg_df.sort_index(inplace=True)
-    avg_df.to_csv(result_file_path)
-    
+        avg_df = pd.read_csv(result_file_path, index_col=0)
+        avg_df.sort_index(kind="mergesort").to_csv(result_file_path)
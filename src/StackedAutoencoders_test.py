@@ -0,0 +1,81 @@
+import numpy as np
+import unittest
+import StackedAutoencoders as mysa
+
+class FakeSession:
+    """
+    Stands for a tf.Session: the fetches are functions of the feed dictionary, and the size of each run is recorded
+    """
+    def __init__(self):
+        self.run_sizes = []
+
+    def run(self, fetches, feed_dict):
+        self.run_sizes.append(len(feed_dict["X"]))
+        return [fetch(feed_dict) for fetch in fetches]
+
+class TestRunInBatches(unittest.TestCase):
+
+    def setUp(self):
+        self.sess = FakeSession()
+        self.X = np.arange(10, dtype=np.float32).reshape(10, 1)
+        self.y = np.arange(10)
+        self.fetches = [lambda feed_dict: np.mean(feed_dict["X"]),
+                        lambda feed_dict: 2 * feed_dict["X"]]
+
+    def test_single_run(self):
+        mean, rows = mysa._run_in_batches(self.sess, self.fetches, {"X": self.X, "y": self.y}, 10)
+        self.assertEqual(self.sess.run_sizes, [10])
+        self.assertAlmostEqual(mean, 4.5)
+        self.assertTrue(np.array_equal(rows, 2 * self.X))
+
+    def test_short_last_batch(self):
+        mean, rows = mysa._run_in_batches(self.sess, self.fetches, {"X": self.X, "y": self.y}, 4)
+        self.assertEqual(self.sess.run_sizes, [4, 4, 2])
+        # Weighted by the batch sizes: the plain mean of the batch means would be (1.5 + 5.5 + 8.5) / 3
+        self.assertAlmostEqual(mean, 4.5)
+        self.assertTrue(np.array_equal(rows, 2 * self.X))
+
+    def test_inputs_sliced_together(self):
+        fetches = [lambda feed_dict: feed_dict["X"][:, 0] - feed_dict["y"]]
+        [diffs] = mysa._run_in_batches(self.sess, fetches, {"X": self.X, "y": self.y}, 3)
+        self.assertEqual(self.sess.run_sizes, [3, 3, 3, 1])
+        self.assertTrue(np.array_equal(diffs, np.zeros(10)))
+
+class TestValidationGate(unittest.TestCase):
+
+    def test_always_open_without_threshold(self):
+        gate = mysa._ValidationGate(None)
+        for train_loss in [1.0, 1.0, 2.0]:
+            gate.update(train_loss)
+            self.assertTrue(gate.should_validate())
+
+    def test_open_before_any_loss(self):
+        self.assertTrue(mysa._ValidationGate(0.01).should_validate())
+
+    def test_open_only_on_improvement(self):
+        # No decay: the moving average is the last training loss
+        gate = mysa._ValidationGate(0.01, decay = 0.0)
+        gate.update(1.0)
+        self.assertTrue(gate.should_validate())
+        gate.update(0.995) # plateau: less than 1% better than the last validation
+        self.assertFalse(gate.should_validate())
+        gate.update(0.98)
+        self.assertTrue(gate.should_validate())
+        gate.update(1.5) # regression
+        self.assertFalse(gate.should_validate())
+        gate.update(0.97) # compared with the last validation (0.98), not with the regression
+        self.assertTrue(gate.should_validate())
+
+    def test_moving_average(self):
+        gate = mysa._ValidationGate(0.1, decay = 0.5)
+        gate.update(1.0)
+        self.assertTrue(gate.should_validate())
+        gate.update(0.0)
+        self.assertAlmostEqual(gate.train_loss_ema, 0.5)
+        self.assertTrue(gate.should_validate())
+        gate.update(0.5)
+        self.assertAlmostEqual(gate.train_loss_ema, 0.5)
+        self.assertFalse(gate.should_validate())
+
+if __name__ == '__main__':
+    unittest.main()
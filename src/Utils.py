@@ -1,6 +1,12 @@
 import os
+import numpy as np
+from collections.abc import Mapping
 import tensorflow as tf
-from datetime import *
+from tensorflow.python.client import device_lib
+import time
+import threading
+import signal
+from functools import lru_cache
 
 def unit_config_str(prefix,
                     n_inputs,
@@ -85,8 +91,104 @@ def config_str(prefix = None,
         s += "_folds{}".format(n_folds)
     return s
 
+# Create the default configuration of the sessions running the models
+def default_session_config(xla_jit = True,
+                           intra_op_parallelism_threads = os.cpu_count(),
+                           inter_op_parallelism_threads = 2):
+    config = tf.ConfigProto(intra_op_parallelism_threads = intra_op_parallelism_threads,
+                            inter_op_parallelism_threads = inter_op_parallelism_threads,
+                            allow_soft_placement = True)
+    # Every unit and stack holds its own session; growing the GPU memory on demand lets them coexist
+    config.gpu_options.allow_growth = True
+    if xla_jit:
+        # Let XLA cluster and fuse the static-shape ops of the training step
+        config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+    return config
+
+class NpyParams(Mapping):
+    """
+    Read-only dictionary of parameter values kept on disk as one .npy file per variable.
+    The values are memory-mapped when accessed, so they are paged in only while being read.
+    """
+    def __init__(self, dir_path, names):
+        self.dir_path = dir_path
+        self.names = list(names)
+
+    @staticmethod
+    def file_name(name):
+        return "{}.npy".format(name.replace("/", "__").replace(":", "_"))
+
+    @classmethod
+    def save(cls, params, dir_path):
+        """
+        Write a dictionary of parameter values to dir_path and return its memory-mapped view
+        """
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+        for name, value in params.items():
+            file_path = os.path.join(dir_path, cls.file_name(name))
+            # Write aside and rename so that arrays still mapped from a previous save remain valid
+            tmp_file_path = file_path + ".tmp"
+            with open(tmp_file_path, "wb") as f:
+                np.save(f, value)
+            os.replace(tmp_file_path, file_path)
+        return cls(dir_path, params.keys())
+
+    def __getitem__(self, name):
+        if name not in self.names:
+            raise KeyError(name)
+        return np.load(os.path.join(self.dir_path, self.file_name(name)), mmap_mode="r")
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+class StopFileWatcher:
+    """
+    Watch for a stop file from a background thread, so that the training loop only reads an in-memory flag
+    instead of checking the file system at every checkpoint. The flag is also raised by the signal signum
+    (e.g. kill -USR1 <pid>), if the watcher is started from the main thread (where Python handles signals).
+    """
+    def __init__(self, file_path, poll_interval = 1.0, signum = getattr(signal, "SIGUSR1", None)):
+        self.file_path = file_path
+        self.poll_interval = poll_interval
+        self.signum = signum
+        self.event = threading.Event()
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._watch, daemon=True)
+        self._previous_handler = None
+
+    def _watch(self):
+        while not self._closed.is_set():
+            if os.path.exists(self.file_path):
+                self.event.set()
+                return
+            self._closed.wait(self.poll_interval)
+
+    def start(self):
+        if self.signum is not None and threading.current_thread() is threading.main_thread():
+            self._previous_handler = signal.signal(self.signum, lambda signum, frame: self.event.set())
+        self._thread.start()
+        return self
+
+    def is_set(self):
+        return self.event.is_set()
+
+    def close(self):
+        self._closed.set()
+        if self._previous_handler is not None:
+            signal.signal(self.signum, self._previous_handler)
+            self._previous_handler = None
+
+# Names of the GPUs visible to TensorFlow. Listing them creates the process-wide GPU allocators: pass the
+# session config so that they grow on demand (allow_growth) instead of reserving all the GPU memory
+@lru_cache(maxsize=None)
+def gpu_devices():
+    devices = device_lib.list_local_devices(session_config=default_session_config())
+    return tuple(device.name for device in devices if device.device_type == "GPU")
+
 # Create a time string
 def timestr():
-    today = datetime.today()
-    month_dict = {1:"jan", 2:"feb", 3:"mar", 4:"apr", 5:"may", 6:"jun", 7:"jul", 8:"aug", 9:"sep", 10:"oct", 11:"nov", 12:"dec"}
-    return "{}{}_{}h{}".format(month_dict[today.month], today.day, today.hour, today.minute)
+    return time.strftime("%b%d_%Hh%M").lower()
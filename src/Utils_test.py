@@ -0,0 +1,42 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+import unittest
+from Utils import NpyParams
+
+class TestNpyParams(unittest.TestCase):
+
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+        self.params = {"unit_hidden/kernel:0": np.arange(6, dtype=np.float32).reshape(2, 3),
+                       "unit_hidden/bias:0": np.zeros(3, dtype=np.float32)}
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path)
+
+    def test_file_name(self):
+        self.assertEqual(NpyParams.file_name("unit_hidden/kernel:0"), "unit_hidden__kernel_0.npy")
+
+    def test_save_and_read(self):
+        params = NpyParams.save(self.params, self.dir_path)
+        self.assertEqual(len(params), 2)
+        self.assertEqual(set(params), set(self.params.keys()))
+        for name, value in self.params.items():
+            self.assertTrue(os.path.exists(os.path.join(self.dir_path, NpyParams.file_name(name))))
+            self.assertTrue(np.array_equal(params[name], value))
+        self.assertIsInstance(params["unit_hidden/kernel:0"], np.memmap)
+        with self.assertRaises(KeyError):
+            params["unit_outputs/kernel:0"]
+
+    def test_overwrite_keeps_mapped_arrays_valid(self):
+        params = NpyParams.save(self.params, self.dir_path)
+        old_kernel = params["unit_hidden/kernel:0"]
+        new_params = {name: value + 1 for name, value in self.params.items()}
+        params = NpyParams.save(new_params, self.dir_path)
+        self.assertTrue(np.array_equal(old_kernel, self.params["unit_hidden/kernel:0"]))
+        self.assertTrue(np.array_equal(params["unit_hidden/kernel:0"], new_params["unit_hidden/kernel:0"]))
+        self.assertFalse(any(file_name.endswith(".tmp") for file_name in os.listdir(self.dir_path)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -27,12 +27,16 @@ def plot_hidden_weights(weights, size, plot_dir_path, seed = 0):
     else:
         raise ValueError("Invalid type of size")
     indices = np.random.permutation(np.arange(n_neurons))[:n_wanted]
+    # A single figure is reused for all neurons, only the data of its line changes
+    fig, axe = plt.subplots()
+    [line] = axe.plot(weights[:,0])
     for idx in indices:
-        fig = plt.figure()
-        plt.plot(weights[:,idx])
+        line.set_ydata(weights[:,idx])
+        axe.relim()
+        axe.autoscale_view()
         plot_file_path = os.path.join(plot_dir_path, "weights_neuron_{}".format(idx))
-        plt.savefig(plot_file_path)
-        plt.close()
+        fig.savefig(plot_file_path)
+    plt.close(fig)
 
 def plot_reconstructed_outputs(X_train, y_train, X_recon, size_per_class, plot_dir_path, seed = 0):
     """
@@ -49,6 +53,10 @@ def plot_reconstructed_outputs(X_train, y_train, X_recon, size_per_class, plot_d
     Return: None
     """
     np.random.seed(seed)
+    # A single figure is reused for all examples, only the data of its lines changes
+    fig, (axe1, axe2) = plt.subplots(2, 1)
+    [line1] = axe1.plot(X_train[0])
+    [line2] = axe2.plot(X_recon[0])
     d = dict([(target, []) for target in y_train])
     for idx, target in enumerate(y_train):
         d[target] += [idx]
@@ -67,16 +75,17 @@ def plot_reconstructed_outputs(X_train, y_train, X_recon, size_per_class, plot_d
             raise ValueError("Invalid type of size")
         indices = np.random.permutation(np.arange(n_examples))[:n_wanted]
         for idx in indices:
-            fig = plt.figure()
-            axe1 = fig.add_subplot(211)
-            axe1.plot(X_train[idx])
+            line1.set_ydata(X_train[idx])
+            axe1.relim()
+            axe1.autoscale_view()
             axe1.set_xlabel("X_train[{}]".format(idx))
-            axe2 = fig.add_subplot(212)
-            axe2.plot(X_recon[idx])
+            line2.set_ydata(X_recon[idx])
+            axe2.relim()
+            axe2.autoscale_view()
             axe2.set_xlabel("X_recon[{}]".format(idx))            
             plot_file_path = os.path.join(target_dir_path, "example_{}".format(idx))
-            plt.savefig(plot_file_path)
-            plt.close()
+            fig.savefig(plot_file_path)
+    plt.close(fig)
         
 
     